@@ -83,7 +83,7 @@ class RuanDynamicGraph(AbstractDynamicGraph):
             f"Expected only one tube be removed each iter but there are {len(removed_tubes)} due to duplicated tube tag"
 
         # Update the list of rest tube in graph
-        self.graph.tubes = [tube for tube in self.graph.tubes if tube.tag != removed_tag]
+        self.graph.remove_tube(removed_tag)
         return removed_tubes, remove_starting_time
 
     @staticmethod
@@ -173,7 +173,7 @@ class RuanDynamicGraph(AbstractDynamicGraph):
             color += 1
 
         # Add new tube to available graph to create new graph G(t+1)
-        self.graph.tubes.append(new_tube)
+        self.graph.add_tube(new_tube)
         return self.graph
 
     def adjusting(self, new_tube: Tube):
@@ -201,13 +201,13 @@ class RuanDynamicGraph(AbstractDynamicGraph):
                         # In paper, authors described tube buffer as a queue,
                         # so I wonder if this could make chronological disorders
                         queue.append(potential_collide_tube)
-                        self.graph.tubes = [tube for tube in self.graph.tubes if tube.tag != potential_collide_tube.tag]
+                        self.graph.remove_tube(potential_collide_tube.tag)
                         break
                 if is_collided_flag:
                     break
 
         # Add new tube to the available graph to create new graph G(t+1)
-        self.graph.tubes.append(new_tube)
+        self.graph.add_tube(new_tube)
 
         # Add all the tubes in the queue into the graph again
         while len(queue):
@@ -1,3 +1,4 @@
+import heapq
 from abc import ABC
 from typing import List
 
@@ -47,16 +48,19 @@ class AbstractGraph(ABC):
         raise Exception("Using default function to clean colors of nodes in the graph from abstract class")
 
     # Optional these 2 can be placed under dynamic graph
-    def remove_tube(self):
+    def remove_tube(self, tag):
         raise Exception("Using default function to remove tube from abstract class")
 
-    def add_tube(self):
+    def add_tube(self, tube: Tube):
         raise Exception("Using default function to add tube from abstract class")
 
 
 class RuanGraph(AbstractGraph):
     def __init__(self, tubes: List[Tube], relations: AbstractRelations):
         super(RuanGraph, self).__init__(tubes, relations)
+        self.end_times = {}  # end time location of each colored tube in the graph, keyed by tube tag
+        self.end_times_heap = []  # max-heap of (-end time, tag), outdated entries are dropped lazily
+        self.reset_end_times()
 
     def compute_graph(self):
         """
@@ -168,15 +172,50 @@ class RuanGraph(AbstractGraph):
         for tube in self.tubes:
             assert tube.tag in starting_times, f"Expect tube with tag: {tube.tag} in starting times dictionary"
             tube.color = starting_times[tube.tag]
+        self.reset_end_times()
+        return
+
+    @staticmethod
+    def tube_end_time(tube: Tube):
+        return tube.color + tube.eframe - tube.sframe
+
+    def reset_end_times(self):
+        """
+        Rebuild the end time records from the colors of the tubes currently in the graph
+        """
+        self.end_times = {tube.tag: self.tube_end_time(tube) for tube in self.tubes if tube.color is not None}
+        self.end_times_heap = [(-end_time, tag) for tag, end_time in self.end_times.items()]
+        heapq.heapify(self.end_times_heap)
+        return
+
+    def add_tube(self, tube: Tube):
+        """
+        Push a colored tube into the graph and record its end time location
+        """
+        self.tubes.append(tube)
+        end_time = self.tube_end_time(tube)
+        self.end_times[tube.tag] = end_time
+        heapq.heappush(self.end_times_heap, (-end_time, tube.tag))
+        return
+
+    def remove_tube(self, tag):
+        """
+        Remove the tube referenced by tag from the graph. Its entry in the heap
+        becomes outdated and is discarded the next time it reaches the top.
+        """
+        self.tubes = [tube for tube in self.tubes if tube.tag != tag]
+        self.end_times.pop(tag, None)
         return
 
     def get_end_time_location(self):
         """
         Calculate the ending time of the last tube in the graph
         This function is used in updating function for dynamic graph to
+        compare adding and adjusting methods, it costs O(log n) amortized per update
         """
-        end_time_location = 0
-        for tube in self.tubes:
-            tube_end = tube.color + tube.eframe - tube.sframe
-            end_time_location = end_time_location if end_time_location >= tube_end else tube_end
-        return end_time_location
+        while self.end_times_heap:
+            neg_end_time, tag = self.end_times_heap[0]
+            if self.end_times.get(tag) == -neg_end_time:
+                return -neg_end_time
+            heapq.heappop(self.end_times_heap)
+        return 0
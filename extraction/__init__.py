@@ -1,61 +1,26 @@
-import os
 from os import path
 import sys
 from tqdm import tqdm
-import shutil
 
+import numpy as np
 import pandas as pd
 import cv2
 
+from extraction.tube import Tube, TubeStore
+from extraction.tracks_file import TRACKS_COLUMNS, TRACKS_SUFFIX, TracksWriter, load_tracks, write_tracks_file
+from extraction.patches import PatchStore, PatchWriter
+from extraction.background import BackgroundExtractor
 from extraction.track import run
-
-
-class Tube:
-    def __init__(self, tag, sframe, eframe):
-        self.tag = tag
-        self.color = None  # the appearance time after re-arranging tubes - color of the start frame
-        self.sframe = sframe
-        self.eframe = eframe
-        self.bbX = []  # bounding box x-axis
-        self.bbY = []  # bounding box y-axis
-        self.bbH = []  # bounding box height
-        self.bbW = []  # bounding box width
-
-    def __len__(self):
-        return len(self.bbX)
-
-    def frame_length(self):
-        return self.eframe - self.sframe
-
-    def next_bounding_box(self, x, y, w, h):
-        self.bbX.append(x)
-        self.bbY.append(y)
-        self.bbW.append(w)
-        self.bbH.append(h)
-
-    def get_bounding_box_at_frame(self, frame):
-        i = frame - self.sframe
-        return self.bbX[i], self.bbY[i], self.bbW[i], self.bbH[i]
-
-    def __iter__(self):
-        self.iteridx = 0
-        return self
-
-    def __next__(self):
-        if self.iteridx < len(self):
-            frame = self.sframe + self.iteridx
-            x, y, h, w = self.get_bounding_box_at_frame(frame)
-            self.iteridx += 1
-            return x, y, h, w, frame
-        else:
-            raise StopIteration
-
-    def __str__(self):
-        return self.tag
+from extraction.sharding import extract_tubes_sharded, split_segments, stitch_segments
 
 
 def extract_tubes(source, outputdir, conf_thres=0.15, yolo_weights='yolov5m6.pt',
-                  strong_sort_weights='osnet_x1_0_market1501.pt', threads=1):
+                  strong_sort_weights='osnet_x1_0_market1501.pt', threads=1, save_tracks_binary=False,
+                  batch_size=1, detect_stride=1, motion_thres=0.0, frame_sinks=None):
+    """
+    Track the objects of a video and return the path of its tracks file. frame_sinks are given to
+    extraction.track.run, e.g. a PatchWriter or a BackgroundExtractor to use the decoded frames as well.
+    """
     weights_folder = path.join(outputdir, 'weights')
     yolo_weights_path = path.join(weights_folder, yolo_weights)
     strong_sort_weights_path = path.join(weights_folder, strong_sort_weights)
@@ -68,44 +33,107 @@ def extract_tubes(source, outputdir, conf_thres=0.15, yolo_weights='yolov5m6.pt'
         strong_sort_weights=strong_sort_weights_path,
         project=path.join(outputdir, 'tubes'),
         threads=threads,
-        conf_thres=conf_thres
+        conf_thres=conf_thres,
+        save_tracks_binary=save_tracks_binary,
+        batch_size=batch_size,
+        detect_stride=detect_stride,
+        motion_thres=motion_thres,
+        frame_sinks=frame_sinks
     )
-    tubes_filename = path.basename(source).split('.')[0] + '.txt'
+    tubes_filename = path.basename(source).split('.')[0] + (TRACKS_SUFFIX if save_tracks_binary else '.txt')
     return path.join(outputdir, f'tubes/exp/tracks/{tubes_filename}')
 
 
+def extract_all(source, outputdir, conf_thres=0.15, yolo_weights='yolov5m6.pt',
+                strong_sort_weights='osnet_x1_0_market1501.pt', threads=1, save_tracks_binary=False,
+                batch_size=1, detect_stride=1, motion_thres=0.0, patch_codec='raw', patch_workers=4,
+                background_refresh_every=None):
+    """
+    Same as extract_tubes, followed by extract_patches and extract_background, in a single decoding
+    of the video: patches and background are taken from the frames decoded for tracking.
+    Returns the paths of the tracks file, the patches and the background, and with background_refresh_every
+    the (frame, path) list of the periodic backgrounds as in extract_background.
+    """
+    patch_writer = PatchWriter(path.join(outputdir, 'patches'), codec=patch_codec, workers=patch_workers)
+    background_extractor = BackgroundExtractor(path.join(outputdir, 'background.png'),
+                                               refresh_every=background_refresh_every)
+    tracks_path = extract_tubes(source, outputdir, conf_thres=conf_thres, yolo_weights=yolo_weights,
+                                strong_sort_weights=strong_sort_weights, threads=threads,
+                                save_tracks_binary=save_tracks_binary, batch_size=batch_size,
+                                detect_stride=detect_stride, motion_thres=motion_thres,
+                                frame_sinks=[patch_writer, background_extractor])
+    outputs = (tracks_path, patch_writer.patches_path, background_extractor.background_path)
+    if background_refresh_every:
+        return outputs + (background_extractor.refreshes,)
+    return outputs
+
+
 def load_tubes_with_pandas(path):
+    """
+    Load the frame, tag, x, y, w, h columns of a MOT text file or of a binary tracks file
+    """
+    if path.endswith(TRACKS_SUFFIX):
+        return pd.DataFrame(np.array(load_tracks(path)), columns=list(TRACKS_COLUMNS))
     columns = ['frame', 'tag', 'x', 'y', 'w', 'h']
-    with open(path) as output:
-        rawdata = [line.strip().split(' ')[:6] for line in output.readlines()]
-        df = pd.DataFrame(rawdata, columns=columns)
-        df = df.astype('int')
+    df = pd.read_csv(path, sep=' ', header=None, usecols=range(len(columns)), names=columns, dtype='int')
     return df
 
 
-def load_tubes_from_pandas_dataframe(df):
+def convert_mot_to_tracks_file(mot_txt_path, tracks_path):
+    """
+    Convert the MOT text file written by the tracker into a binary tracks file
+    """
+    df = load_tubes_with_pandas(mot_txt_path)
+    return write_tracks_file(tracks_path, df['frame'].to_numpy(), df['tag'].to_numpy(),
+                             df[['x', 'y', 'w', 'h']].to_numpy())
+
+
+def load_tubes_from_arrays(tags, frames, boxes, min_length=10, stationary_margin=20):
+    """
+    Build tubes from flat per-detection arrays: tags (N,), frames (N,) and boxes (N, 4) of x, y, w, h.
+    Rows are sorted once by (tag, frame) and every tube is a slice of the sorted boxes.
+    Tubes are returned in order of first appearance of their tags in the input rows.
+    As in load_tubes_from_json_file, the frames of a tube are sframe, sframe + 1, ...
+    one per box: frames missed by the tracker are not kept, so eframe can be after the last of them.
+    """
+    tags, frames = np.asarray(tags), np.asarray(frames)
+    boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+    if len(tags) == 0:
+        return []
+    nframes = frames.max()
+
+    order = np.lexsort((frames, tags))
+    sorted_tags, sorted_frames, sorted_boxes = tags[order], frames[order], boxes[order]
+    unique_tags, starts, counts = np.unique(sorted_tags, return_index=True, return_counts=True)
+    ends = starts + counts
+    sframes, eframes = sorted_frames[starts], sorted_frames[ends - 1]
+
+    keep = counts >= min_length  # remove shadows
+    # TODO: Fix this check. It's better to determine if an object
+    # is stationary using the coordinates instead of this.
+    keep &= eframes - sframes < nframes - stationary_margin  # remove stationary objects
+
+    # Tags are visited in the order they first appear in the input, like df.tag.unique()
+    _, first_appearances = np.unique(tags, return_index=True)
     tubes = []
-    nframes = df.frame.max()
-    for tag in df.tag.unique():
-        ob_df = df[df['tag'] == tag]
-        if (len(ob_df) < 10): continue  # remove shadows
-        ob_df = ob_df.sort_values(by='frame')
-        sframe = ob_df.frame.min()
-        eframe = ob_df.frame.max()
-
-        # TODO: Fix this check. It's better to determine if an object 
-        # is stationary using the coordinates instead of this.  
-        if (eframe - sframe >= nframes - 20): continue  # remove stationary objects
-
-        tube = Tube(tag, sframe, eframe)
+    for i in np.argsort(first_appearances, kind='stable'):
+        if not keep[i]:
+            continue
+        tube = Tube.from_arrays(unique_tags[i], sorted_boxes[starts[i]:ends[i]], sframe=sframes[i], eframe=eframes[i])
         tubes.append(tube)
-        for _, r in ob_df.iterrows():
-            tube.next_bounding_box(r['x'], r['y'], r['w'], r['h'])
     return tubes
 
 
+def load_tubes_from_pandas_dataframe(df):
+    return load_tubes_from_arrays(df['tag'].to_numpy(), df['frame'].to_numpy(), df[['x', 'y', 'w', 'h']].to_numpy())
+
+
 def _create_frames_dictionary(source_tubes):
     frames = {}
+    if source_tubes.endswith(TRACKS_SUFFIX):
+        for f, id, x, y, w, h in load_tracks(source_tubes).tolist():
+            frames.setdefault(f, []).append([id, x, y, w, h])
+        return frames
     with open(source_tubes, 'r') as f:
         for line in f:
             f, id, x, y, w, h = line.split()[0:6]
@@ -115,56 +143,47 @@ def _create_frames_dictionary(source_tubes):
     return frames
 
 
-def extract_patches(source, outputdir, path_tubes):
+def extract_patches(source, outputdir, path_tubes, codec='raw', workers=4):
     frames = _create_frames_dictionary(path_tubes)
     cap = cv2.VideoCapture(source)
-    patchespath = path.join(outputdir, 'patches')
+    patch_writer = PatchWriter(path.join(outputdir, 'patches'), codec=codec, workers=workers)
     nframes = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     pbar = tqdm(total=nframes)
 
-    if path.exists(patchespath):
-        shutil.rmtree(patchespath)
-    os.mkdir(patchespath)
-
     ret = True
     num_frame = 1
     while ret:
         ret, frame = cap.read()
         if frame is not None and num_frame in frames.keys():
-            for id, x, y, w, h in frames[num_frame]:
-                ROI = frame[y:y + h, x:x + w].copy()
-                filename = str(id) + "_" + str(num_frame) + '.png'
-                cv2.imwrite(path.join(patchespath, filename), ROI)
+            patch_writer.write(num_frame, frame, frames[num_frame])
         num_frame += 1
         pbar.update(1)
     pbar.close()
-    return patchespath
+    return patch_writer.close()
 
 
-def extract_background(source, outputdir, path_tubes):
+def extract_background(source, outputdir, path_tubes, refresh_every=None):
+    """
+    Estimate the background of a video in one pass with BackgroundExtractor, frames that are
+    not sampled are skipped without being decoded. Returns the path of the background of the
+    whole video. When refresh_every is given, the periodic backgrounds are written next to it and
+    the (frame, path) list of them is returned as well.
+    """
     frames = _create_frames_dictionary(path_tubes)
     cap = cv2.VideoCapture(source)
-    ret = True
-    count_bg = 0
-    num_frame = 1
-    bgpath = path.join(outputdir, 'background.png')
-    emergencybg = None
+    background_extractor = BackgroundExtractor(path.join(outputdir, 'background.png'), refresh_every=refresh_every)
 
-    while ret:
-        ret, frame = cap.read()
-        if emergencybg is None and frame is not None:
-            emergencybg = frame
-        if num_frame in frames.keys():
-            count_bg = 0
-        elif count_bg > 10:
-            cv2.imwrite(bgpath, frame)
-            ret = False
-        else:
-            count_bg += 1
+    num_frame = 1
+    while cap.grab():
+        if background_extractor.wants(num_frame):
+            ret, frame = cap.retrieve()
+            if ret:
+                boxes = [(x, y, w, h) for _, x, y, w, h in frames.get(num_frame, [])]
+                background_extractor.update(num_frame, frame, boxes)
         num_frame += 1
-        print(f'extracting background | frame {num_frame}')
-
-    if count_bg <= 10:
-        cv2.imwrite(bgpath, emergencybg)
+    cap.release()
 
-    return bgpath
+    background_path = background_extractor.close()
+    if refresh_every:
+        return background_path, background_extractor.refreshes
+    return background_path
@@ -0,0 +1,88 @@
+from os import path
+
+import cv2
+import numpy as np
+
+
+class BackgroundExtractor:
+    """
+    Streaming background model: temporal median of frames sampled every sample_every frames.
+    Only the last samples frames are kept, so memory is bounded whatever the length of the video.
+    Before a frame is kept, the pixels inside tracked boxes are replaced by their last value seen
+    outside of any tracked box, so that objects, even stopped ones, do not leak into the background.
+    Pixels that have not been seen outside of a box yet are left out of the median.
+    With refresh_every, the estimate is also written every refresh_every frames as
+    background_{frame}.png next to background_path.
+    Can be given to extraction.track.run as a frame sink to get the background while tracking.
+    """
+
+    def __init__(self, background_path, samples=11, sample_every=25, refresh_every=None):
+        self.background_path = background_path
+        self.samples = samples
+        self.sample_every = sample_every
+        self.refresh_every = refresh_every
+        self.ring = None  # (samples, H, W, C) kept frames
+        self.valid = None  # (samples, H, W) whether each pixel of the kept frames shows the background
+        self.count = 0  # number of frames kept so far
+        self.last_clean = None  # last value of each pixel outside of tracked boxes
+        self.known = None  # whether each pixel has been seen outside of tracked boxes
+        self.last_refresh = 0
+        self.refreshes = []  # (frame, path) of the backgrounds written by the periodic refresh
+
+    def wants(self, frame_number):
+        """Whether the frame will be sampled, frames that are not can be skipped without being decoded"""
+        return (frame_number - 1) % self.sample_every == 0
+
+    def estimate(self):
+        n = min(self.count, self.samples)
+        ring, valid = self.ring[:n], self.valid[:n]
+        valid = valid | ~valid.any(axis=0)  # pixels never seen outside of a box take the median of all frames
+        valid = valid.reshape(valid.shape + (1,) * (ring.ndim - valid.ndim))
+        # Invalid pixels are sorted last, the median is taken among the valid ones and stays uint8
+        ordered = np.where(valid, ring, np.iinfo(ring.dtype).max)
+        ordered.sort(axis=0)
+        middle = valid.sum(axis=0) // 2
+        return np.take_along_axis(ordered, middle[None], axis=0)[0]
+
+    def update(self, frame_number, image, boxes):
+        """
+        Sample a frame if it is one of the sampled ones, boxes are the x, y, w, h of its tracked objects
+        """
+        if not self.wants(frame_number):
+            return
+        if self.ring is None:
+            self.ring = np.empty((self.samples,) + image.shape, dtype=image.dtype)
+            self.valid = np.empty((self.samples,) + image.shape[:2], dtype=bool)
+            self.last_clean = np.zeros_like(image)
+            self.known = np.zeros(image.shape[:2], dtype=bool)
+        masked = np.zeros(image.shape[:2], dtype=bool)
+        for x, y, w, h in boxes:
+            x, y = max(int(x), 0), max(int(y), 0)
+            masked[y:y + int(h), x:x + int(w)] = True
+        masked_pixels = masked.reshape(masked.shape + (1,) * (image.ndim - 2))
+
+        slot = self.count % self.samples
+        self.ring[slot] = image
+        # Pixels not seen outside of a box yet keep their raw value, the median falls back on them
+        replaced = masked & self.known
+        np.copyto(self.ring[slot], self.last_clean, where=replaced.reshape(masked_pixels.shape))
+        self.valid[slot] = ~masked | self.known
+        np.copyto(self.last_clean, image, where=~masked_pixels)
+        self.known |= ~masked
+        self.count += 1
+
+        if self.refresh_every and frame_number - self.last_refresh >= self.refresh_every:
+            refresh_path = f'{path.splitext(self.background_path)[0]}_{frame_number:06d}.png'
+            cv2.imwrite(refresh_path, self.estimate())
+            self.refreshes.append((frame_number, refresh_path))
+            self.last_refresh = frame_number
+
+    def add_frame(self, frame_number, image, outputs):
+        boxes = [(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2, *_ in outputs]
+        self.update(frame_number, image, boxes)
+
+    def close(self):
+        if not self.count:  # no frame was given, e.g. the tracking failed on the first one
+            return None
+        cv2.imwrite(self.background_path, self.estimate())
+        return self.background_path
@@ -0,0 +1,59 @@
+"""
+Decide on which frames the detector has to run.
+- stride: detection runs on one frame out of detect_stride, the tracks are predicted on the others
+- static: nothing moved since the last detected frame, the tracks are only aged
+A frame is static when less than motion_thres of the pixels of a small blurred gray
+version of it differ from the last detected frame, which catches slow motion that
+differences between consecutive frames would miss.
+"""
+import cv2
+import numpy as np
+
+SKIP_STRIDE = 'stride'
+SKIP_STATIC = 'static'
+
+
+class MotionGate:
+    def __init__(self, detect_stride=1, motion_thres=0.0, width=160, pixel_thres=25):
+        """
+        detect_stride: run the detector every detect_stride frames
+        motion_thres: fraction of changed pixels under which a frame is static, 0 disables the motion gate
+        width: width of the downscaled gray frames compared by the gate
+        pixel_thres: gray level difference for a pixel to count as changed
+        """
+        assert detect_stride >= 1, f"Expected a detection stride of at least 1 but got {detect_stride}"
+        self.detect_stride = detect_stride
+        self.motion_thres = motion_thres
+        self.width = width
+        self.pixel_thres = pixel_thres
+        self.references = None  # small gray frames of the last detected frame, one per source
+        self.since_detection = detect_stride  # frames since the last detected frame, the first frame is detected
+
+    def small_gray(self, image):
+        height = max(int(round(image.shape[0] * self.width / image.shape[1])), 1)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        gray = cv2.resize(gray, (self.width, height), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+
+    def motion(self, small, reference):
+        return np.count_nonzero(cv2.absdiff(small, reference) > self.pixel_thres) / small.size
+
+    def skip_reason(self, images):
+        """
+        Returns None if the detector has to run on the frame made of the images of each source,
+        otherwise SKIP_STRIDE or SKIP_STATIC
+        """
+        self.since_detection += 1
+        if self.motion_thres > 0:
+            smalls = [self.small_gray(image) for image in images]
+            if self.references is not None and all(small.shape == reference.shape and
+                                                   self.motion(small, reference) < self.motion_thres
+                                                   for small, reference in zip(smalls, self.references)):
+                return SKIP_STATIC
+        if self.since_detection < self.detect_stride:
+            return SKIP_STRIDE
+
+        self.since_detection = 0
+        if self.motion_thres > 0:
+            self.references = smalls
+        return None
@@ -0,0 +1,170 @@
+"""
+Patch store: the patches of all tracked bounding boxes of a video in two files of a directory
+- patches.bin: the patches appended one after the other, as raw pixels or PNG encoded
+- index.npz: tag, frame, offset and size in patches.bin and shape (h, w, c) of each patch,
+  sorted by tag then frame so that a patch is found by binary search
+Raw patches are read from a memory map of patches.bin without decoding nor copying.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+import cv2
+import numpy as np
+
+PATCHES_BLOB = 'patches.bin'
+PATCHES_INDEX = 'index.npz'
+PATCH_CODECS = ('raw', 'png')
+
+
+class PatchWriter:
+    """
+    Append the patch of every tracked bounding box to a patch store in patches_path.
+    codec is raw for the fastest writes and reads, or png for lossless compression
+    with the given zlib level. Can be given to extraction.track.run as a frame sink
+    to crop patches while tracking.
+    With the png codec and workers > 0, patches are encoded by a pool of threads (OpenCV releases the GIL
+    while encoding) and appended in order as they are done. At most max_pending patches wait for their
+    encoding, beyond that append blocks until the oldest one is written.
+    Raw patches need no encoding and are always written as they come.
+    """
+
+    def __init__(self, patches_path, codec='raw', png_compression=1, workers=0, max_pending=None):
+        assert codec in PATCH_CODECS, f"Unknown patch codec {codec}, expected one of {PATCH_CODECS}"
+        self.patches_path = patches_path
+        self.codec = codec
+        self.png_compression = png_compression
+        os.makedirs(patches_path, exist_ok=True)
+        self.blob = open(path.join(patches_path, PATCHES_BLOB), 'wb')
+        self.offset = 0
+        self.tags, self.frames, self.offsets, self.sizes, self.shapes = [], [], [], [], []
+        self.executor = None
+        if workers and codec == 'png':
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='patch-encoder')
+        self.pending = deque()  # (tag, frame, shape, future) of the patches being encoded, in order
+        self.max_pending = max_pending or 4 * workers
+
+    def encode(self, roi):
+        if self.codec == 'png':
+            ok, buffer = cv2.imencode('.png', roi, [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression])
+            assert ok, "Could not encode a patch as PNG"
+            return buffer
+        return np.ascontiguousarray(roi)
+
+    def append(self, tag, frame_number, roi):
+        if self.executor is None:
+            self._write(tag, frame_number, roi.shape, self.encode(roi))
+            return
+        # The patch is copied, the frame it comes from can be reused once append returns
+        self.pending.append((tag, frame_number, roi.shape, self.executor.submit(self.encode, roi.copy())))
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _write(self, tag, frame_number, shape, buffer):
+        self.blob.write(buffer)
+        self.tags.append(int(tag))
+        self.frames.append(int(frame_number))
+        self.offsets.append(self.offset)
+        self.sizes.append(buffer.nbytes)
+        self.shapes.append((shape[0], shape[1], shape[2] if len(shape) == 3 else 1))
+        self.offset += buffer.nbytes
+
+    def _write_next(self):
+        tag, frame_number, shape, future = self.pending.popleft()
+        self._write(tag, frame_number, shape, future.result())
+
+    def flush(self):
+        """Wait for the patches being encoded and write them"""
+        while self.pending:
+            self._write_next()
+
+    def write(self, frame_number, image, boxes):
+        """
+        Write the patches of a frame, boxes are rows of tag, x, y, w, h
+        """
+        for tag, x, y, w, h in boxes:
+            roi = image[y:y + h, x:x + w]
+            if roi.size:
+                self.append(tag, frame_number, roi)
+
+    def add_frame(self, frame_number, image, outputs):
+        """
+        Write the patches of the StrongSORT outputs (x1, y1, x2, y2, id, class, conf) of a frame
+        """
+        boxes = [(int(tag), int(x1), int(y1), int(x2 - x1), int(y2 - y1)) for x1, y1, x2, y2, tag, *_ in outputs]
+        self.write(frame_number, image, boxes)
+
+    def close(self):
+        if self.blob is None:
+            return self.patches_path
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.blob.close()
+        self.blob = None
+        tags, frames = np.array(self.tags, dtype=np.int64), np.array(self.frames, dtype=np.int64)
+        order = np.lexsort((frames, tags))
+        np.savez(path.join(self.patches_path, PATCHES_INDEX),
+                 codec=np.array(self.codec),
+                 tags=tags[order],
+                 frames=frames[order],
+                 offsets=np.array(self.offsets, dtype=np.int64)[order],
+                 sizes=np.array(self.sizes, dtype=np.int64)[order],
+                 shapes=np.array(self.shapes, dtype=np.int32).reshape(-1, 3)[order])
+        return self.patches_path
+
+
+class PatchStore:
+    """
+    Random access to the patches of a patch store by (tag, frame)
+    """
+
+    def __init__(self, patches_path):
+        index = np.load(path.join(patches_path, PATCHES_INDEX))
+        self.patches_path = patches_path
+        self.codec = str(index['codec'])
+        self.tags = index['tags']
+        self.frames = index['frames']
+        self.offsets = index['offsets']
+        self.sizes = index['sizes']
+        self.shapes = index['shapes']
+        blob_path = path.join(patches_path, PATCHES_BLOB)
+        self.blob = np.memmap(blob_path, dtype=np.uint8, mode='r') if path.getsize(blob_path) else np.empty(0, np.uint8)
+        # Single sorted key per patch, tags and frames being sorted lexicographically
+        self._stride = int(self.frames.max()) + 1 if len(self.frames) else 1
+        self._keys = self.tags * self._stride + self.frames
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _find(self, tag, frame):
+        if not 0 <= frame < self._stride:
+            return None
+        key = int(tag) * self._stride + int(frame)
+        i = np.searchsorted(self._keys, key)
+        return i if i < len(self._keys) and self._keys[i] == key else None
+
+    def __contains__(self, tag_frame):
+        return self._find(*tag_frame) is not None
+
+    def frames_of(self, tag):
+        """Frames at which there is a patch of tag"""
+        start, end = np.searchsorted(self.tags, tag), np.searchsorted(self.tags, tag, side='right')
+        return self.frames[start:end]
+
+    def get(self, tag, frame):
+        """
+        Patch of tag at frame as an (h, w, c) uint8 image, raw patches are read-only views of the store
+        """
+        i = self._find(tag, frame)
+        if i is None:
+            raise KeyError(f"No patch of tag {tag} at frame {frame} in {self.patches_path}")
+        data = self.blob[self.offsets[i]:self.offsets[i] + self.sizes[i]]
+        if self.codec == 'png':
+            image = cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+            return image if image.ndim == 3 else image[:, :, None]
+        return data.reshape(self.shapes[i])
+
+    def __getitem__(self, tag_frame):
+        return self.get(*tag_frame)
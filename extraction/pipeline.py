@@ -0,0 +1,134 @@
+"""
+Background stages to overlap the steps of the extraction: every stage runs in its own thread,
+maps a function over the items of its source and hands the results over through a bounded queue,
+so a slow stage holds the stages before it back instead of letting frames pile up in memory.
+Stages keep the order of their source, a stage can be the source of the next one.
+"""
+import queue
+import threading
+import time
+
+_END = object()
+
+
+class _StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+class StageStats:
+    """
+    Timings of a stage and depth of its output queue
+    - read_time: time spent waiting for items from the source (decoding for a stage reading a dataset)
+    - work_time: time spent in the stage function
+    - put_time: time spent blocked on a full output queue, i.e. waiting for the next stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.read_time = 0.0
+        self.work_time = 0.0
+        self.put_time = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+
+    def record_depth(self, depth):
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    @property
+    def depth_mean(self):
+        return self.depth_total / self.items if self.items else 0.0
+
+    def __str__(self):
+        per_item = 1E3 / max(self.items, 1)
+        return (f'{self.name}: {self.items} items, {self.read_time * per_item:.1f}ms read, '
+                f'{self.work_time * per_item:.1f}ms work, {self.put_time * per_item:.1f}ms blocked per item, '
+                f'queue depth {self.depth_mean:.1f} mean / {self.depth_max} max')
+
+
+class Stage(threading.Thread):
+    """
+    Apply fn to the items of source in a background thread. Iterating the stage yields the
+    results in order, exceptions raised in the thread are raised again in the iterating thread.
+    """
+
+    def __init__(self, name, source, fn=None, maxsize=4):
+        super().__init__(name=name, daemon=True)
+        self.source = source
+        self.fn = fn
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stats = StageStats(name)
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            items = iter(self.source)
+            while not self._stopped.is_set():
+                t0 = time.perf_counter()
+                item = next(items, _END)
+                if item is _END:
+                    break
+                t1 = time.perf_counter()
+                result = self.fn(item) if self.fn is not None else item
+                t2 = time.perf_counter()
+                self._put(result)
+                self.stats.items += 1
+                self.stats.read_time += t1 - t0
+                self.stats.work_time += t2 - t1
+                self.stats.put_time += time.perf_counter() - t2
+        except BaseException as e:
+            self._put(_StageError(e))
+        finally:
+            self._put(_END)
+
+    def _put(self, item):
+        # Give up on a full queue once the stage is stopped so the thread can exit
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        if self.ident is None:  # the first iteration starts the thread
+            self.start()
+        while True:
+            # Poll so that the iterating thread, e.g. the thread of the next stage, gives up once
+            # the stage is stopped: the stage thread may then exit without putting _END
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._stopped.is_set():
+                    return
+                continue
+            if item is _END:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            self.stats.record_depth(self.queue.qsize())
+            yield item
+
+    def stop(self):
+        self._stopped.set()
+        if isinstance(self.source, Stage):
+            self.source.stop()
+
+
+def batched(items, batch_size, key=None):
+    """
+    Group consecutive items into lists of up to batch_size items.
+    A new batch is started whenever key(item) changes, e.g. on a change of image shape.
+    """
+    batch, batch_key = [], None
+    for item in items:
+        item_key = key(item) if key is not None else None
+        if batch and (len(batch) == batch_size or item_key != batch_key):
+            yield batch
+            batch = []
+        batch.append(item)
+        batch_key = item_key
+    if batch:
+        yield batch
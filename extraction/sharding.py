@@ -0,0 +1,224 @@
+"""
+Sharded extraction of long videos: the video is split into overlapping segments that are
+tracked in parallel processes, then the track ids of consecutive segments are stitched by
+matching their tracks on the overlap, on IoU and optionally on re-ID features.
+In the output every overlap is cut in the middle, the first half comes from the earlier segment
+and the second half from the later one, which has then had half of the overlap to confirm its tracks.
+"""
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import path
+
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from extraction.track import run
+from yolov5.utils.torch_utils import select_device
+from extraction.tracks_file import BufferedTracksWriter
+from extraction.strong_sort.deep.reid_model_factory import get_model_name
+from extraction.strong_sort.deep.reid.torchreid.utils import FeatureExtractor
+
+MOT_COLUMNS = 10
+
+
+def split_segments(nframes, segment_length, overlap):
+    """
+    Split the frames [0, nframes) into segments (start, end) of segment_length frames,
+    each segment sharing its first overlap frames with the previous one
+    """
+    assert 0 <= overlap < segment_length, \
+        f"Expected an overlap smaller than the segment length but got {overlap} >= {segment_length}"
+    segments, start = [], 0
+    while True:
+        end = min(start + segment_length, nframes)
+        segments.append((start, end))
+        if end >= nframes:
+            return segments
+        start = end - overlap
+
+
+def _track_segment(kwargs):
+    run(**kwargs)
+    stem = path.basename(kwargs['source']).split('.')[0]
+    return path.join(kwargs['project'], kwargs['name'], 'tracks', stem + '.txt')
+
+
+def _load_mot_rows(mot_txt_path):
+    if not path.exists(mot_txt_path):  # no object was tracked in the segment
+        return np.empty((0, MOT_COLUMNS))
+    return np.loadtxt(mot_txt_path, ndmin=2).reshape(-1, MOT_COLUMNS)
+
+
+def _box_iou(a, b):
+    """IoU between (N, 4) and (M, 4) boxes x, y, w, h"""
+    tl = np.maximum(a[:, None, :2], b[None, :, :2])
+    br = np.minimum(a[:, None, :2] + a[:, None, 2:], b[None, :, :2] + b[None, :, 2:])
+    inter = np.prod(np.clip(br - tl, 0, None), axis=2)
+    union = np.prod(a[:, 2:], axis=1)[:, None] + np.prod(b[:, 2:], axis=1)[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def overlap_iou(prev_rows, next_rows, min_common_frames=3):
+    """
+    Mean IoU of every pair of tracks of two segments over the frames where both appear.
+    Returns the tags of prev_rows, the tags of next_rows and the (P, Q) mean IoU matrix,
+    pairs seen together on less than min_common_frames frames get an IoU of 0.
+    """
+    prev_tags, prev_idx = np.unique(prev_rows[:, 1], return_inverse=True)
+    next_tags, next_idx = np.unique(next_rows[:, 1], return_inverse=True)
+    iou_sum = np.zeros((len(prev_tags), len(next_tags)))
+    common = np.zeros((len(prev_tags), len(next_tags)), dtype=np.int64)
+    for frame in np.intersect1d(prev_rows[:, 0], next_rows[:, 0]):
+        a, b = prev_rows[:, 0] == frame, next_rows[:, 0] == frame
+        rows, cols = np.ix_(prev_idx[a], next_idx[b])
+        iou_sum[rows, cols] += _box_iou(prev_rows[a, 2:6], next_rows[b, 2:6])
+        common[rows, cols] += 1
+    iou = np.where(common >= min_common_frames, iou_sum / np.maximum(common, 1), 0.)
+    return prev_tags, next_tags, iou
+
+
+def track_features(extractor, source, rows, samples=4):
+    """
+    Mean normalized re-ID feature of each track of rows, from up to samples boxes per track.
+    Only the frames holding sampled boxes are decoded. Tracks whose frames could not be read get no feature.
+    """
+    sampled = []
+    for tag in np.unique(rows[:, 1]):
+        track = rows[rows[:, 1] == tag]
+        sampled.append(track[np.linspace(0, len(track) - 1, min(samples, len(track))).astype(int)])
+    sampled = np.concatenate(sampled)
+    sampled = sampled[np.argsort(sampled[:, 0], kind='stable')]
+
+    features = {}
+    cap = cv2.VideoCapture(source)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, int(sampled[0, 0]) - 1)  # MOT frames start from 1
+    frame_number = int(sampled[0, 0]) - 1
+    for frame in np.unique(sampled[:, 0]):
+        ret = True
+        while ret and frame_number < frame:
+            ret, image = cap.read()
+            frame_number += 1
+        if not ret:  # the video ends before the frame, the remaining frames cannot be read either
+            break
+        boxes = sampled[sampled[:, 0] == frame]
+        xyxy = np.concatenate((boxes[:, 2:4], boxes[:, 2:4] + boxes[:, 4:6]), axis=1).astype(np.float32)
+        for tag, feature in zip(boxes[:, 1], extractor.extract_boxes(image, xyxy).cpu().numpy()):
+            features.setdefault(tag, []).append(feature / max(np.linalg.norm(feature), 1e-9))
+    cap.release()
+    return {tag: np.mean(feature, axis=0) for tag, feature in features.items()}
+
+
+def match_tracks(prev_rows, next_rows, min_iou=0.3, extractor=None, source=None, appearance_weight=0.5):
+    """
+    Match the tracks of two segments on their common frames.
+    Returns a dictionary mapping tags of next_rows to the matched tags of prev_rows.
+    """
+    if not len(prev_rows) or not len(next_rows):
+        return {}
+    prev_tags, next_tags, iou = overlap_iou(prev_rows, next_rows)
+    cost = 1. - iou
+    if extractor is not None and appearance_weight > 0:
+        prev_features = track_features(extractor, source, prev_rows)
+        next_features = track_features(extractor, source, next_rows)
+        features = list(prev_features.values()) + list(next_features.values())
+        # A track without feature gets a zero vector, hence the neutral appearance cost of 1
+        missing = np.zeros_like(features[0]) if features else np.zeros(0)
+        prev_matrix = np.stack([prev_features.get(tag, missing) for tag in prev_tags])
+        next_matrix = np.stack([next_features.get(tag, missing) for tag in next_tags])
+        norms = np.linalg.norm(prev_matrix, axis=1)[:, None] * np.linalg.norm(next_matrix, axis=1)[None, :]
+        appearance_cost = 1. - prev_matrix @ next_matrix.T / np.maximum(norms, 1e-9)
+        cost = (1. - appearance_weight) * cost + appearance_weight * appearance_cost
+    cost[iou < min_iou] = 1e5  # the boxes have to agree, appearance only breaks ties
+
+    rows, cols = linear_sum_assignment(cost)
+    return {next_tags[j]: prev_tags[i] for i, j in zip(rows, cols) if iou[i, j] >= min_iou}
+
+
+def stitch_segments(segment_rows, segments, **match_kwargs):
+    """
+    Merge the MOT rows of consecutive overlapping segments into the rows of the whole video,
+    with track ids made consistent across segments
+    """
+    merged = []
+    next_id = 1
+    prev_ids = {}  # tag in the previous segment -> stitched id
+    for k, (rows, (start, end)) in enumerate(zip(segment_rows, segments)):
+        ids = {}
+        if k > 0:
+            overlap_end = segments[k - 1][1]
+            prev_rows = segment_rows[k - 1]
+            in_overlap_prev = prev_rows[:, 0] > start
+            in_overlap_next = rows[:, 0] <= overlap_end
+            matches = match_tracks(prev_rows[in_overlap_prev], rows[in_overlap_next], **match_kwargs)
+            ids = {tag: prev_ids[prev_tag] for tag, prev_tag in matches.items()}
+        for tag in np.unique(rows[:, 1]):
+            if tag not in ids:
+                ids[tag] = next_id
+                next_id += 1
+
+        # Keep the frames from the middle of the previous overlap to the middle of the next one
+        low = (start + segments[k - 1][1]) // 2 if k > 0 else start
+        high = (segments[k + 1][0] + end) // 2 if k + 1 < len(segments) else end
+        kept = rows[(rows[:, 0] > low) & (rows[:, 0] <= high)].copy()  # MOT frames start from 1
+        kept[:, 1] = [ids[tag] for tag in kept[:, 1]]
+        merged.append(kept)
+        prev_ids = ids
+
+    merged = np.concatenate(merged) if merged else np.empty((0, MOT_COLUMNS))
+    return merged[np.argsort(merged[:, 0], kind='stable')]
+
+
+def extract_tubes_sharded(source, outputdir, conf_thres=0.15, yolo_weights='yolov5m6.pt',
+                          strong_sort_weights='osnet_x1_0_market1501.pt', threads=1, save_tracks_binary=False,
+                          segment_length=9000, overlap=150, workers=2, min_iou=0.3, appearance_weight=0.5,
+                          device='cpu'):
+    """
+    Same as extract_tubes, with the video tracked as overlapping segments in a pool of workers processes.
+    appearance_weight is the share of the re-ID distance in the cost of matching tracks between segments,
+    0 matches them on IoU alone. device is given to the trackers as in run, e.g. cpu or 0.
+    """
+    weights_folder = path.join(outputdir, 'weights')
+    strong_sort_weights_path = path.join(weights_folder, strong_sort_weights)
+    cap = cv2.VideoCapture(source)
+    nframes = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    segments = split_segments(nframes, segment_length, overlap)
+    segments_dir = path.join(outputdir, 'tubes', 'segments')
+    if path.exists(segments_dir):
+        shutil.rmtree(segments_dir)  # text tracks files are appended to, start from empty ones
+    jobs = [dict(source=source,
+                 yolo_weights=path.join(weights_folder, yolo_weights),
+                 strong_sort_weights=strong_sort_weights_path,
+                 project=segments_dir,
+                 name=f'segment_{k:04d}',
+                 threads=threads,
+                 conf_thres=conf_thres,
+                 device=device,
+                 start_frame=start,
+                 end_frame=end)
+            for k, (start, end) in enumerate(segments)]
+    # spawn rather than fork, the workers load their own models and may use CUDA
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+        segment_rows = [_load_mot_rows(mot_txt_path) for mot_txt_path in executor.map(_track_segment, jobs)]
+
+    extractor = None
+    if appearance_weight > 0 and len(segments) > 1:
+        reid_device = str(select_device(device))  # as in run, '' picks the first GPU if there is one
+        extractor = FeatureExtractor(model_name=get_model_name(strong_sort_weights_path),
+                                     model_path=strong_sort_weights_path, device=reid_device, verbose=False)
+    rows = stitch_segments(segment_rows, segments, min_iou=min_iou, extractor=extractor, source=source,
+                           appearance_weight=appearance_weight)
+
+    tracks_dir = path.join(outputdir, 'tubes', 'exp', 'tracks')
+    os.makedirs(tracks_dir, exist_ok=True)
+    tracks_path = path.join(tracks_dir, path.basename(source).split('.')[0])
+    if path.exists(tracks_path + '.txt'):
+        os.remove(tracks_path + '.txt')  # text writers append, drop the output of a previous run
+    writer = BufferedTracksWriter(tracks_path, binary=save_tracks_binary)
+    writer.write(rows)
+    writer.close()
+    return writer.path
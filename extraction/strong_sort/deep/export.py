@@ -0,0 +1,86 @@
+"""
+Export re-ID checkpoints to TorchScript and ONNX for inference without the eager torchreid model.
+
+Usage:
+$ python -m extraction.strong_sort.deep.export
+$ python -m extraction.strong_sort.deep.export --weights extraction/strong_sort/deep/checkpoint/osnet_x0_25_msmt17.pth --include onnx
+
+Artifacts are written next to each checkpoint with the suffixes .torchscript and .onnx,
+both taking a (B, 3, H, W) batch with a dynamic batch size. Give one of them as
+strong_sort_weights and FeatureExtractor picks the matching backend.
+"""
+import argparse
+from glob import glob
+from os import path
+
+import torch
+
+from extraction.strong_sort.deep.reid_model_factory import get_model_name
+from extraction.strong_sort.deep.reid.torchreid.models import build_model
+from extraction.strong_sort.deep.reid.torchreid.utils import load_pretrained_weights
+
+CHECKPOINT_DIR = path.join(path.dirname(path.abspath(__file__)), 'checkpoint')
+EXPORT_FORMATS = ('torchscript', 'onnx')
+
+
+def load_reid_model(weights):
+    model_name = get_model_name(weights)
+    assert model_name is not None, f"Cannot infer the model architecture from {weights}"
+    model = build_model(model_name, num_classes=1, pretrained=False, use_gpu=False)
+    load_pretrained_weights(model, weights)
+    return model.eval()
+
+
+def export_torchscript(model, sample, export_path):
+    traced = torch.jit.trace(model, sample)
+    traced = torch.jit.freeze(traced)
+    traced.save(export_path)
+    return export_path
+
+
+def export_onnx(model, sample, export_path, opset=12):
+    torch.onnx.export(
+        model, sample, export_path,
+        opset_version=opset,
+        input_names=['images'],
+        output_names=['features'],
+        dynamic_axes={'images': {0: 'batch'}, 'features': {0: 'batch'}}
+    )
+    return export_path
+
+
+def export_weights(weights, include=EXPORT_FORMATS, image_size=(256, 128), opset=12):
+    """
+    Export a checkpoint to the given formats, returns the paths of the artifacts
+    """
+    model = load_reid_model(weights)
+    sample = torch.zeros(1, 3, image_size[0], image_size[1])
+    stem = path.splitext(weights)[0]
+    exported = []
+    with torch.no_grad():
+        if 'torchscript' in include:
+            exported.append(export_torchscript(model, sample, stem + '.torchscript'))
+        if 'onnx' in include:
+            exported.append(export_onnx(model, sample, stem + '.onnx', opset=opset))
+    return exported
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', nargs='+', type=str,
+                        default=sorted(glob(path.join(CHECKPOINT_DIR, 'osnet_x0_25_*.pth'))),
+                        help='re-ID checkpoints to export')
+    parser.add_argument('--include', nargs='+', default=list(EXPORT_FORMATS), choices=EXPORT_FORMATS)
+    parser.add_argument('--image-size', nargs=2, type=int, default=[256, 128], help='input height and width')
+    parser.add_argument('--opset', type=int, default=12, help='ONNX opset version')
+    return parser.parse_args()
+
+
+def main(opt):
+    for weights in opt.weights:
+        for exported in export_weights(weights, opt.include, opt.image_size, opt.opset):
+            print(f'Exported {weights} to {exported}')
+
+
+if __name__ == '__main__':
+    main(parse_opt())
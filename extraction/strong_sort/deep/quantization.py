@@ -0,0 +1,171 @@
+"""
+INT8 post-training quantization of the OSNet re-ID models for CPU inference.
+
+Usage:
+$ python -m extraction.strong_sort.deep.quantization --source video.mp4 --tracks video.txt
+$ python -m extraction.strong_sort.deep.quantization --source video.mp4 --tracks video.txt --mode dynamic
+
+Crops for calibration and evaluation are cut from one of our videos using the MOT
+tracks written by extract_tubes, the track id being the identity of each crop.
+- dynamic: weights of the linear layers are quantized, activations are quantized on the fly
+- static: every layer is quantized, activation ranges are calibrated on the crops
+The quantized model is compared to the fp32 one with the mAP and rank-1 of
+torchreid.metrics.evaluate_rank, and saved as <weights>.int8.torchscript when
+both stay within the tolerance. FeatureExtractor loads it as any TorchScript model.
+"""
+import argparse
+import sys
+from os import path
+
+import cv2
+import numpy as np
+import torch
+from torch import nn
+
+from extraction.strong_sort.deep.export import CHECKPOINT_DIR, load_reid_model
+from extraction.strong_sort.deep.reid.torchreid.metrics import compute_distance_matrix, evaluate_rank
+from extraction.strong_sort.deep.reid.torchreid.utils import BoxPreprocessor
+
+QUANTIZATION_MODES = ('dynamic', 'static')
+
+
+def quantize_dynamic(model):
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static(model, calibration_batches, backend='fbgemm'):
+    """
+    Quantize every layer with FX graph mode, observing the activations of the calibration batches
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = backend
+    example = calibration_batches[0][:1]
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs=(example,))
+    with torch.no_grad():
+        for images in calibration_batches:
+            prepared(images)
+    return convert_fx(prepared)
+
+
+def quantize_model(model, mode, calibration_batches=None):
+    model = model.cpu().eval()
+    if mode == 'dynamic':
+        return quantize_dynamic(model)
+    if mode == 'static':
+        assert calibration_batches, "Static quantization needs calibration crops"
+        return quantize_static(model, calibration_batches)
+    raise ValueError(f"Unknown quantization mode {mode}, expected one of {QUANTIZATION_MODES}")
+
+
+def load_track_crops(preprocess_boxes, source, mot_txt_path, crops_per_track=8, max_crops=1024):
+    """
+    Cut up to crops_per_track evenly spaced crops of each track of a video with preprocess_boxes,
+    a BoxPreprocessor or the preprocess_boxes method of a FeatureExtractor.
+    Returns the preprocessed crops (N, 3, H, W) and the track id of each crop.
+    """
+    rows = np.loadtxt(mot_txt_path, usecols=range(6), ndmin=2).astype(np.int64)  # frame, id, x, y, w, h
+    rows = rows[(rows[:, 4] > 1) & (rows[:, 5] > 1)]
+    selected = []
+    for tag in np.unique(rows[:, 1]):
+        track = rows[rows[:, 1] == tag]
+        if len(track) >= 2:
+            step = max(len(track) // crops_per_track, 1)
+            selected.append(track[::step][:crops_per_track])
+    assert selected, f"No track with at least 2 boxes in {mot_txt_path}"
+    selected = np.concatenate(selected)[:max_crops]
+    selected = selected[np.argsort(selected[:, 0], kind='stable')]
+
+    crops, pids = [], []
+    cap = cv2.VideoCapture(source)
+    frame_idx, i = 0, 0
+    while i < len(selected):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frame_idx += 1  # MOT frames start from 1
+        j = i
+        while j < len(selected) and selected[j, 0] == frame_idx:
+            j += 1
+        if j > i:
+            x, y, w, h = selected[i:j, 2:6].T
+            boxes = np.stack((x, y, x + w, y + h), axis=1).astype(np.float32)
+            crops.append(preprocess_boxes(frame, boxes).cpu())
+            pids.append(selected[i:j, 1])
+            i = j
+    cap.release()
+    return torch.cat(crops), np.concatenate(pids)
+
+
+def extract_features(model, crops, batch_size=64):
+    with torch.no_grad():
+        return torch.cat([model(crops[i:i + batch_size]) for i in range(0, len(crops), batch_size)])
+
+
+def evaluate_features(features, pids, max_rank=10):
+    """
+    Rank-1 and mAP of re-identifying the crops of each track, alternate crops of a track
+    being used as query and as gallery so that they look like two camera views
+    """
+    order = np.argsort(pids, kind='stable')
+    features, pids = features[torch.from_numpy(order)], pids[order]
+    _, first = np.unique(pids, return_index=True)
+    position = np.arange(len(pids)) - np.repeat(first, np.diff(np.append(first, len(pids))))
+    query = position % 2 == 0
+    camids = (~query).astype(np.int64)
+
+    distmat = compute_distance_matrix(features[torch.from_numpy(query)], features[torch.from_numpy(~query)],
+                                      metric='cosine').numpy()
+    cmc, mAP = evaluate_rank(distmat, pids[query], pids[~query], camids[query], camids[~query],
+                             max_rank=max_rank)
+    return cmc[0], mAP
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=path.join(CHECKPOINT_DIR, 'osnet_x0_25_msmt17.pth'))
+    parser.add_argument('--source', type=str, required=True, help='video to cut crops from')
+    parser.add_argument('--tracks', type=str, required=True, help='MOT txt tracks of the video')
+    parser.add_argument('--mode', type=str, default='static', choices=QUANTIZATION_MODES)
+    parser.add_argument('--crops-per-track', type=int, default=8)
+    parser.add_argument('--max-crops', type=int, default=1024)
+    parser.add_argument('--calibration-ratio', type=float, default=0.5,
+                        help='part of the tracks used for calibration, the others are used for evaluation')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='largest accepted drop of mAP and rank-1')
+    parser.add_argument('--image-size', nargs=2, type=int, default=[256, 128], help='input height and width')
+    return parser.parse_args()
+
+
+def main(opt):
+    # Only the crops are needed here, the model is loaded once below
+    preprocess_boxes = BoxPreprocessor(image_size=opt.image_size, device='cpu')
+    crops, pids = load_track_crops(preprocess_boxes, opt.source, opt.tracks, opt.crops_per_track, opt.max_crops)
+
+    # Calibrate and evaluate on different identities
+    tags = np.unique(pids)
+    calibration_tags = tags[:int(len(tags) * opt.calibration_ratio)]
+    calibration = torch.from_numpy(np.isin(pids, calibration_tags))
+    calibration_batches = list(torch.split(crops[calibration], 32)) if opt.mode == 'static' else None
+    crops, pids = crops[~calibration], pids[~calibration.numpy()]
+    print(f'{int(calibration.sum())} calibration crops, {len(crops)} evaluation crops of {len(np.unique(pids))} tracks')
+
+    model = load_reid_model(opt.weights)
+    rank1, mAP = evaluate_features(extract_features(model, crops), pids)
+    quantized = quantize_model(model, opt.mode, calibration_batches)
+    q_rank1, q_mAP = evaluate_features(extract_features(quantized, crops), pids)
+    print(f'fp32: rank-1 {rank1:.2%} mAP {mAP:.2%}')
+    print(f'int8 ({opt.mode}): rank-1 {q_rank1:.2%} mAP {q_mAP:.2%}')
+
+    if rank1 - q_rank1 > opt.tolerance or mAP - q_mAP > opt.tolerance:
+        print(f'Accuracy drop larger than {opt.tolerance:.2%}, the quantized model is not saved')
+        sys.exit(1)
+
+    export_path = path.splitext(opt.weights)[0] + '.int8.torchscript'
+    with torch.no_grad():
+        torch.jit.trace(quantized, crops[:1]).save(export_path)
+    print(f'Saved quantized model to {export_path}')
+
+
+if __name__ == '__main__':
+    main(parse_opt())
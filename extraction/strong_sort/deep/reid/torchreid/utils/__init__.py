@@ -7,4 +7,4 @@ from .avgmeter import *
 from .reidtools import *
 from .torchtools import *
 from .model_complexity import compute_model_complexity
-from .feature_extractor import FeatureExtractor
+from .feature_extractor import BoxPreprocessor, FeatureExtractor
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 import numpy as np
 import torch
 import torchvision.transforms as T
+from torchvision.ops import roi_align
 from PIL import Image
 
 from extraction.strong_sort.deep.reid.torchreid.utils import (
@@ -10,6 +11,57 @@ from extraction.strong_sort.deep.reid.torchreid.utils import (
 from extraction.strong_sort.deep.reid.torchreid.models import build_model
 
 
+class BoxPreprocessor(object):
+    """Crops, resizes and normalizes boxes of an image in one batch.
+
+    Only needs the input size and normalization of a model, not the model
+    itself, so crops can be prepared without building or loading a model.
+
+    Args:
+        image_size (sequence or int): crop height and width.
+        pixel_mean (list): pixel mean for normalization.
+        pixel_std (list): pixel std for normalization.
+        pixel_norm (bool): whether to normalize pixels.
+        device (str or torch.device): device the crops are made on.
+    """
+
+    def __init__(
+        self,
+        image_size=(256, 128),
+        pixel_mean=[0.485, 0.456, 0.406],
+        pixel_std=[0.229, 0.224, 0.225],
+        pixel_norm=True,
+        device='cpu'
+    ):
+        self.device = torch.device(device)
+        self.image_size = tuple(image_size)
+        # (x / 255 - mean) / std folded into a single multiply-subtract
+        pixel_std = torch.tensor(pixel_std if pixel_norm else [1., 1., 1.])
+        pixel_mean = torch.tensor(pixel_mean if pixel_norm else [0., 0., 0.])
+        self.pixel_scale = (1. / (255. * pixel_std)).view(1, 3, 1, 1).to(self.device)
+        self.pixel_shift = (pixel_mean / pixel_std).view(1, 3, 1, 1).to(self.device)
+
+    def __call__(self, image, boxes):
+        """Crops and resizes boxes of an image in one batch.
+
+        Args:
+            image (numpy.ndarray): image with shape (H, W, C), uploaded once to the device.
+            boxes (numpy.ndarray or torch.Tensor): (N, 4) boxes x1, y1, x2, y2
+                in pixels, x2 and y2 being exclusive as in ``image[y1:y2, x1:x2]``.
+
+        Returns:
+            torch.Tensor: normalized crops with shape (N, C, H, W).
+        """
+        image = torch.from_numpy(np.ascontiguousarray(image)).to(self.device)
+        image = image.permute(2, 0, 1).unsqueeze(0).float()
+        boxes = torch.as_tensor(boxes, dtype=torch.float32, device=self.device).view(-1, 4)
+        rois = torch.cat([boxes.new_zeros(len(boxes), 1), boxes], dim=1)
+        # With aligned=True the box borders are pixel borders, and the adaptive
+        # sampling ratio averages several samples per output pixel when shrinking
+        crops = roi_align(image, rois, output_size=self.image_size, spatial_scale=1., sampling_ratio=-1, aligned=True)
+        return crops.mul_(self.pixel_scale).sub_(self.pixel_shift)
+
+
 class FeatureExtractor(object):
     """A simple API for feature extraction.
 
@@ -24,9 +76,18 @@ class FeatureExtractor(object):
     Returned is a torch tensor with shape (B, D) where D is the
     feature dimension.
 
+    Besides torchreid checkpoints, model_path can point to a .torchscript
+    or .onnx artifact made by ``extraction.strong_sort.deep.export``. The model
+    is then loaded with torch.jit or onnxruntime without building it.
+
+    To extract features of many boxes of the same image, use
+    ``extract_boxes`` which crops, resizes and normalizes all boxes
+    in a single batch on the model device.
+
     Args:
         model_name (str): model name.
-        model_path (str): path to model weights.
+        model_path (str): path to model weights, or to an exported
+            .torchscript or .onnx model.
         image_size (sequence or int): image height and width.
         pixel_mean (list): pixel mean for normalization.
         pixel_std (list): pixel std for normalization.
@@ -67,25 +128,28 @@ class FeatureExtractor(object):
         device='cuda',
         verbose=True
     ):
-        # Build model
-        model = build_model(
-            model_name,
-            num_classes=1,
-            pretrained=not (model_path and check_isfile(model_path)),
-            use_gpu=device.startswith('cuda')
-        )
-        model.eval()
+        backend = self.backend_from_path(model_path)
 
-        if verbose:
-            num_params, flops = compute_model_complexity(
-                model, (1, 3, image_size[0], image_size[1])
+        if backend == 'pytorch':
+            # Build model
+            model = build_model(
+                model_name,
+                num_classes=1,
+                pretrained=not (model_path and check_isfile(model_path)),
+                use_gpu=device.startswith('cuda')
             )
-            print('Model: {}'.format(model_name))
-            print('- params: {:,}'.format(num_params))
-            print('- flops: {:,}'.format(flops))
+            model.eval()
 
-        if model_path and check_isfile(model_path):
-            load_pretrained_weights(model, model_path)
+            if verbose:
+                num_params, flops = compute_model_complexity(
+                    model, (1, 3, image_size[0], image_size[1])
+                )
+                print('Model: {}'.format(model_name))
+                print('- params: {:,}'.format(num_params))
+                print('- flops: {:,}'.format(flops))
+
+            if model_path and check_isfile(model_path):
+                load_pretrained_weights(model, model_path)
 
         # Build transform functions
         transforms = []
@@ -98,13 +162,60 @@ class FeatureExtractor(object):
         to_pil = T.ToPILImage()
 
         device = torch.device(device)
-        model.to(device)
+        if backend == 'onnx':
+            model = self.load_onnx_session(model_path, device)
+        elif backend == 'torchscript':
+            model = torch.jit.load(model_path, map_location=device)
+            model.eval()
+        else:
+            model.to(device)
 
         # Class attributes
+        self.backend = backend
         self.model = model
         self.preprocess = preprocess
         self.to_pil = to_pil
         self.device = device
+        self.image_size = tuple(image_size)
+        self.box_preprocessor = BoxPreprocessor(image_size, pixel_mean, pixel_std, pixel_norm, device)
+
+    @staticmethod
+    def backend_from_path(model_path):
+        if model_path.endswith('.onnx'):
+            return 'onnx'
+        if model_path.endswith('.torchscript'):
+            return 'torchscript'
+        return 'pytorch'
+
+    @staticmethod
+    def load_onnx_session(model_path, device):
+        import onnxruntime as ort
+
+        providers = ['CPUExecutionProvider']
+        if device.type == 'cuda':
+            providers.insert(0, 'CUDAExecutionProvider')
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(model_path, sess_options=options, providers=providers)
+
+    def forward(self, images):
+        """Runs the model on a (B, C, H, W) batch with the loaded backend."""
+        if self.backend == 'onnx':
+            inputs = {self.model.get_inputs()[0].name: images.cpu().numpy()}
+            features = self.model.run(None, inputs)[0]
+            return torch.from_numpy(features).to(self.device)
+
+        with torch.no_grad():
+            return self.model(images)
+
+    def preprocess_boxes(self, image, boxes):
+        """Crops and resizes boxes of an image in one batch, see ``BoxPreprocessor``."""
+        return self.box_preprocessor(image, boxes)
+
+    def extract_boxes(self, image, boxes):
+        """Returns the features of the boxes x1, y1, x2, y2 of an image, see ``preprocess_boxes``."""
+        images = self.preprocess_boxes(image, boxes)
+        return self.forward(images)
 
     def __call__(self, input):
         if isinstance(input, list):
@@ -146,7 +257,4 @@ class FeatureExtractor(object):
         else:
             raise NotImplementedError
 
-        with torch.no_grad():
-            features = self.model(images)
-
-        return features
+        return self.forward(images)
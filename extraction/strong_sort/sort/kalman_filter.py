@@ -211,4 +211,195 @@ class KalmanFilter(object):
             cholesky_factor, d.T, lower=True, check_finite=False,
             overwrite_b=True)
         squared_maha = np.sum(z * z, axis=0)
-        return squared_maha
\ No newline at end of file
+        return squared_maha
+
+
+class BatchKalmanFilter(KalmanFilter):
+    """
+    A Kalman filter that runs the steps of many tracks at once.
+    The mean vectors (Nx8) and covariance matrices (Nx8x8) of all the tracks
+    are stored here, each track holds the index of its row. Predict, update
+    and gating are single batched operations over the selected rows.
+    """
+
+    def __init__(self, capacity=32):
+        super(BatchKalmanFilter, self).__init__()
+        ndim = self._update_mat.shape[1]
+        self.means = np.zeros((capacity, ndim))
+        self.covariances = np.zeros((capacity, ndim, ndim))
+        self.size = 0
+
+    def add(self, measurement):
+        """Create the state of a new track from an unassociated measurement.
+        Returns
+        -------
+        int
+            The row of the new state in the store.
+        """
+        if self.size == len(self.means):
+            self.means = np.concatenate([self.means, np.zeros_like(self.means)])
+            self.covariances = np.concatenate([self.covariances, np.zeros_like(self.covariances)])
+        row = self.size
+        self.means[row], self.covariances[row] = self.initiate(measurement)
+        self.size += 1
+        return row
+
+    def compact(self, rows):
+        """Keep only the states of the given rows and move them, in order,
+        to the rows 0, ..., len(rows) - 1.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        self.means[:len(rows)] = self.means[rows]
+        self.covariances[:len(rows)] = self.covariances[rows]
+        self.size = len(rows)
+
+    def predict_rows(self, rows):
+        """Run the prediction step on the states of the given rows."""
+        if len(rows) == 0:
+            return
+        self.means[rows], self.covariances[rows] = self.multi_predict(self.means[rows], self.covariances[rows])
+
+    def update_rows(self, rows, measurements, confidences):
+        """Run the correction step on the states of the given rows, where
+        `measurements[i]` and `confidences[i]` belong to `rows[i]`.
+        """
+        if len(rows) == 0:
+            return
+        self.means[rows], self.covariances[rows] = self.multi_update(
+            self.means[rows], self.covariances[rows], measurements, confidences)
+
+    def gating_distance_rows(self, rows, measurements, only_position=False):
+        """Gating distance between the states of the given rows and the
+        measurements, see `multi_gating_distance`.
+        """
+        return self.multi_gating_distance(self.means[rows], self.covariances[rows], measurements, only_position)
+
+    def multi_predict(self, mean, covariance):
+        """Run Kalman filter prediction step on N states.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean vectors of the object states at the previous
+            time step.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices of the object states at the
+            previous time step.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the mean vectors and covariance matrices of the predicted
+            states.
+        """
+        std = np.stack([
+            self._std_weight_position * mean[:, 0],
+            self._std_weight_position * mean[:, 1],
+            1 * mean[:, 2],
+            self._std_weight_position * mean[:, 3],
+            self._std_weight_velocity * mean[:, 0],
+            self._std_weight_velocity * mean[:, 1],
+            0.1 * mean[:, 2],
+            self._std_weight_velocity * mean[:, 3]], axis=1)
+        motion_cov = _batch_diag(np.square(std))
+
+        mean = mean @ self._motion_mat.T
+        covariance = self._motion_mat @ covariance @ self._motion_mat.T + motion_cov
+        return mean, covariance
+
+    def multi_project(self, mean, covariance, confidence=.0):
+        """Project N state distributions to measurement space.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean vectors.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices.
+        confidence : float | ndarray
+            Detection confidence of each state, scalar or of length N.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx4 projected means and Nx4x4 covariance matrices.
+        """
+        confidence = np.broadcast_to(np.asarray(confidence, dtype=np.float64), (len(mean),))
+        std = np.stack([
+            self._std_weight_position * mean[:, 3],
+            self._std_weight_position * mean[:, 3],
+            np.full(len(mean), 1e-1),
+            self._std_weight_position * mean[:, 3]], axis=1)
+        std = (1 - confidence)[:, None] * std
+        innovation_cov = _batch_diag(np.square(std))
+
+        mean = mean @ self._update_mat.T
+        covariance = self._update_mat @ covariance @ self._update_mat.T
+        return mean, covariance + innovation_cov
+
+    def multi_update(self, mean, covariance, measurement, confidence=.0):
+        """Run Kalman filter correction step on N states.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional predicted mean vectors.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices.
+        measurement : ndarray
+            The Nx4 dimensional measurements (x, y, a, h), one per state.
+        confidence : float | ndarray
+            Detection confidence of each measurement.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the measurement-corrected state distributions.
+        """
+        projected_mean, projected_cov = self.multi_project(mean, covariance, confidence)
+
+        # kalman_gain = P H^T S^-1, solved as S^T K^T = (P H^T)^T
+        cross_cov = covariance @ self._update_mat.T
+        kalman_gain = np.linalg.solve(projected_cov, np.swapaxes(cross_cov, 1, 2))
+        kalman_gain = np.swapaxes(kalman_gain, 1, 2)
+        innovation = np.asarray(measurement) - projected_mean
+
+        new_mean = mean + np.einsum('nij,nj->ni', kalman_gain, innovation)
+        new_covariance = covariance - kalman_gain @ projected_cov @ np.swapaxes(kalman_gain, 1, 2)
+        return new_mean, new_covariance
+
+    def multi_gating_distance(self, mean, covariance, measurements, only_position=False):
+        """Compute gating distance between N state distributions and M measurements.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean vectors.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices.
+        measurements : ndarray
+            An Mx4 dimensional matrix of M measurements (x, y, a, h).
+        only_position : Optional[bool]
+            If True, distance computation is done with respect to the bounding
+            box center position only.
+        Returns
+        -------
+        ndarray
+            Returns an NxM matrix, where element (i, j) contains the squared
+            Mahalanobis distance between state i and `measurements[j]`.
+        """
+        mean, covariance = self.multi_project(mean, covariance)
+        measurements = np.asarray(measurements)
+
+        if only_position:
+            mean, covariance = mean[:, :2], covariance[:, :2, :2]
+            measurements = measurements[:, :2]
+        if len(mean) == 0 or len(measurements) == 0:
+            return np.zeros((len(mean), len(measurements)))
+
+        cholesky_factor = np.linalg.cholesky(covariance)
+        d = measurements[None, :, :] - mean[:, None, :]
+        z = np.linalg.solve(cholesky_factor, np.swapaxes(d, 1, 2))
+        squared_maha = np.sum(z * z, axis=1)
+        return squared_maha
+
+
+def _batch_diag(values):
+    """Build a stack of diagonal matrices from the rows of an NxD matrix."""
+    n, d = values.shape
+    diag = np.zeros((n, d, d))
+    diag[:, np.arange(d), np.arange(d)] = values
+    return diag
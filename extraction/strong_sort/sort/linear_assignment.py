@@ -132,10 +132,10 @@ def gate_cost_matrix(
         cost_matrix, tracks, detections, track_indices, detection_indices,
         gated_cost=INFTY_COST, only_position=False):
     """Invalidate infeasible entries in cost matrix based on the state
-    distributions obtained by Kalman filtering.
+    distributions obtained by Kalman filtering, in the batched filter
+    shared by the tracks.
     Parameters
     ----------
-    kf : The Kalman filter.
     cost_matrix : ndarray
         The NxM dimensional cost matrix, where N is the number of track indices
         and M is the number of detection indices, such that entry (i, j) is the
@@ -166,9 +166,13 @@ def gate_cost_matrix(
     gating_threshold = kalman_filter.chi2inv95[gating_dim]
     measurements = np.asarray(
         [detections[i].to_xyah() for i in detection_indices])
-    for row, track_idx in enumerate(track_indices):
-        track = tracks[track_idx]
-        gating_distance = track.kf.gating_distance(track.mean, track.covariance, measurements, only_position)
-        cost_matrix[row, gating_distance > gating_threshold] = gated_cost
-        cost_matrix[row] = 0.995 * cost_matrix[row] + (1 - 0.995) *  gating_distance
+    if len(track_indices) == 0:
+        return cost_matrix
+
+    # All the tracks of a tracker share one batched Kalman filter
+    kf = tracks[track_indices[0]].kf
+    rows = [tracks[track_idx].row for track_idx in track_indices]
+    gating_distance = kf.gating_distance_rows(rows, measurements, only_position)
+    cost_matrix[gating_distance > gating_threshold] = gated_cost
+    cost_matrix[:] = 0.995 * cost_matrix + (1 - 0.995) * gating_distance
     return cost_matrix
\ No newline at end of file
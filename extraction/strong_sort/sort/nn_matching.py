@@ -1,7 +1,5 @@
 # vim: expandtab:ts=4:sw=4
 import numpy as np
-import torch
-from extraction.strong_sort.deep.reid.torchreid.metrics.distance import compute_distance_matrix
 
 
 def _pdist(a, b):
@@ -50,51 +48,51 @@ def _cosine_distance(a, b, data_is_normalized=False):
     return 1. - np.dot(a, b.T)
 
 
-def _nn_euclidean_distance(x, y):
+def _normalize(x):
+    """Scale the rows of `x` to unit length, leaving all-zero rows untouched."""
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def _nn_euclidean_distance(similarities):
     """ Helper function for nearest neighbor distance metric (Euclidean).
     Parameters
     ----------
-    x : ndarray
-        A matrix of N row-vectors (sample points).
-    y : ndarray
-        A matrix of M row-vectors (query points).
+    similarities : ndarray
+        A TxM matrix with, for each of T targets, the largest dot product
+        between its unit length samples and each of M unit length queries.
     Returns
     -------
     ndarray
-        A vector of length M that contains for each entry in `y` the
-        smallest Euclidean distance to a sample in `x`.
+        A TxM matrix with the smallest squared Euclidean distance between
+        the samples of each target and each query.
     """
-    x_ = torch.from_numpy(np.asarray(x) / np.linalg.norm(x, axis=1, keepdims=True))
-    y_ = torch.from_numpy(np.asarray(y) / np.linalg.norm(y, axis=1, keepdims=True))
-    distances = compute_distance_matrix(x_, y_, metric='euclidean')
-    return np.maximum(0.0, torch.min(distances, axis=0)[0].numpy())
+    return np.maximum(0.0, 2. - 2. * similarities)
 
 
-def _nn_cosine_distance(x, y):
+def _nn_cosine_distance(similarities):
     """ Helper function for nearest neighbor distance metric (cosine).
     Parameters
     ----------
-    x : ndarray
-        A matrix of N row-vectors (sample points).
-    y : ndarray
-        A matrix of M row-vectors (query points).
+    similarities : ndarray
+        A TxM matrix with, for each of T targets, the largest dot product
+        between its unit length samples and each of M unit length queries.
     Returns
     -------
     ndarray
-        A vector of length M that contains for each entry in `y` the
-        smallest cosine distance to a sample in `x`.
+        A TxM matrix with the smallest cosine distance between
+        the samples of each target and each query.
     """
-    x_ = torch.from_numpy(np.asarray(x))
-    y_ = torch.from_numpy(np.asarray(y))
-    distances = compute_distance_matrix(x_, y_, metric='cosine')
-    distances = distances.cpu().detach().numpy()
-    return distances.min(axis=0)
+    return 1. - similarities
 
 
 class NearestNeighborDistanceMetric(object):
     """
     A nearest neighbor distance metric that, for each target, returns
     the closest distance to any sample that has been observed so far.
+    Samples are kept normalized in a preallocated gallery where every target
+    owns one row used as a ring buffer of its most recent samples.
     Parameters
     ----------
     metric : str
@@ -107,12 +105,17 @@ class NearestNeighborDistanceMetric(object):
         the oldest samples when the budget is reached.
     Attributes
     ----------
-    samples : Dict[int -> List[ndarray]]
-        A dictionary that maps from target identities to the list of samples
-        that have been observed so far.
+    gallery : ndarray
+        A float32 array of shape (capacity, budget, M) holding the unit length
+        samples of each target row.
+    counts : ndarray
+        Number of samples ever added to each row, the row holds the last
+        min(count, budget) of them.
+    slots : Dict[int -> int]
+        A dictionary that maps from target identities to their gallery row.
     """
 
-    def __init__(self, metric, matching_threshold, budget=None):
+    def __init__(self, metric, matching_threshold, budget=None, capacity=32):
         if metric == "euclidean":
             self._metric = _nn_euclidean_distance
         elif metric == "cosine":
@@ -122,7 +125,46 @@ class NearestNeighborDistanceMetric(object):
                 "Invalid metric; must be either 'euclidean' or 'cosine'")
         self.matching_threshold = matching_threshold
         self.budget = budget
-        self.samples = {}
+        self.capacity = capacity
+        self.gallery = None  # allocated on the first partial_fit, once the feature size is known
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.slots = {}
+        self._free = list(range(capacity - 1, -1, -1))
+
+    @property
+    def samples(self):
+        """Dict[int -> ndarray] view of the samples kept for each target."""
+        return {target: self.gallery[slot, :min(self.counts[slot], self.gallery.shape[1])]
+                for target, slot in self.slots.items()}
+
+    def _allocate(self, dim):
+        length = self.budget if self.budget is not None else 16
+        self.gallery = np.zeros((self.capacity, length, dim), dtype=np.float32)
+
+    def _grow_rows(self):
+        capacity = 2 * len(self.counts)
+        gallery = np.zeros((capacity,) + self.gallery.shape[1:], dtype=np.float32)
+        gallery[:len(self.counts)] = self.gallery
+        counts = np.zeros(capacity, dtype=np.int64)
+        counts[:len(self.counts)] = self.counts
+        self._free.extend(range(capacity - 1, len(self.counts) - 1, -1))
+        self.gallery, self.counts = gallery, counts
+
+    def _grow_samples(self):
+        # Only happens without a budget, the gallery then keeps every sample
+        length = 2 * self.gallery.shape[1]
+        gallery = np.zeros((self.gallery.shape[0], length, self.gallery.shape[2]), dtype=np.float32)
+        gallery[:, :self.gallery.shape[1]] = self.gallery
+        self.gallery = gallery
+
+    def _slot(self, target):
+        slot = self.slots.get(target)
+        if slot is None:
+            if not self._free:
+                self._grow_rows()
+            slot = self._free.pop()
+            self.slots[target] = slot
+        return slot
 
     def partial_fit(self, features, targets, active_targets):
         """Update the distance metric with new data.
@@ -135,11 +177,22 @@ class NearestNeighborDistanceMetric(object):
         active_targets : List[int]
             A list of targets that are currently present in the scene.
         """
+        features = _normalize(features)
+        if self.gallery is None and len(features):
+            self._allocate(features.shape[1])
         for feature, target in zip(features, targets):
-            self.samples.setdefault(target, []).append(feature)
-            if self.budget is not None:
-                self.samples[target] = self.samples[target][-self.budget:]
-        self.samples = {k: self.samples[k] for k in active_targets}
+            slot = self._slot(target)
+            count = self.counts[slot]
+            if self.budget is None and count == self.gallery.shape[1]:
+                self._grow_samples()
+            self.gallery[slot, count % self.gallery.shape[1]] = feature
+            self.counts[slot] = count + 1
+
+        active_targets = set(active_targets)
+        for target in [k for k in self.slots if k not in active_targets]:
+            slot = self.slots.pop(target)
+            self.counts[slot] = 0
+            self._free.append(slot)
 
     def distance(self, features, targets):
         """Compute distance between features and targets.
@@ -156,7 +209,14 @@ class NearestNeighborDistanceMetric(object):
             element (i, j) contains the closest squared distance between
             `targets[i]` and `features[j]`.
         """
-        cost_matrix = np.zeros((len(targets), len(features)))
-        for i, target in enumerate(targets):
-            cost_matrix[i, :] = self._metric(self.samples[target], features)
-        return cost_matrix
\ No newline at end of file
+        if len(targets) == 0 or len(features) == 0:
+            return np.zeros((len(targets), len(features)))
+        slots = np.array([self.slots[target] for target in targets])
+        fills = np.minimum(self.counts[slots], self.gallery.shape[1])
+        samples = self.gallery[slots, :fills.max()]  # (T, S, M)
+
+        # One matrix multiply for every sample of every target, then the
+        # best sample per target ignoring the unfilled part of the ring buffers
+        similarities = samples @ _normalize(features).T  # (T, S, N)
+        similarities[np.arange(samples.shape[1])[None, :] >= fills[:, None]] = -np.inf
+        return self._metric(similarities.max(axis=1)).astype(np.float64)
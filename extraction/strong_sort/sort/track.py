@@ -1,7 +1,158 @@
 # vim: expandtab:ts=4:sw=4
 import cv2
 import numpy as np
-from strong_sort.sort.kalman_filter import KalmanFilter
+from strong_sort.sort.kalman_filter import BatchKalmanFilter
+
+
+def ECC(src, dst, warp_mode = cv2.MOTION_EUCLIDEAN, eps = 1e-5,
+        max_iter = 100, scale = 0.1, align = False):
+    """Compute the warp matrix from src to dst.
+    Parameters
+    ----------
+    src : ndarray 
+        An NxM matrix of source img(BGR or Gray), it must be the same format as dst.
+    dst : ndarray
+        An NxM matrix of target img(BGR or Gray).
+    warp_mode: flags of opencv
+        translation: cv2.MOTION_TRANSLATION
+        rotated and shifted: cv2.MOTION_EUCLIDEAN
+        affine(shift,rotated,shear): cv2.MOTION_AFFINE
+        homography(3d): cv2.MOTION_HOMOGRAPHY
+    eps: float
+        the threshold of the increment in the correlation coefficient between two iterations
+    max_iter: int
+        the number of iterations.
+    scale: float or [int, int]
+        scale_ratio: float
+        scale_size: [W, H]
+    align: bool
+        whether to warp affine or perspective transforms to the source image
+    Returns
+    -------
+    warp matrix : ndarray
+        Returns the warp matrix from src to dst.
+        if motion models is homography, the warp matrix will be 3x3, otherwise 2x3
+    src_aligned: ndarray
+        aligned source image of gray
+    """
+    if src is None or dst is None:
+        return None, None
+    assert src.shape == dst.shape, "the source image must be the same format to the target image!"
+
+    # BGR2GRAY
+    if src.ndim == 3:
+        # Convert images to grayscale
+        src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
+        dst = cv2.cvtColor(dst, cv2.COLOR_BGR2GRAY)
+
+    # make the imgs smaller to speed up
+    if scale is not None:
+        if isinstance(scale, float) or isinstance(scale, int):
+            if scale != 1:
+                src_r = cv2.resize(src, (0, 0), fx = scale, fy = scale,interpolation =  cv2.INTER_LINEAR)
+                dst_r = cv2.resize(dst, (0, 0), fx = scale, fy = scale,interpolation =  cv2.INTER_LINEAR)
+                scale = [scale, scale]
+            else:
+                src_r, dst_r = src, dst
+                scale = None
+        else:
+            if scale[0] != src.shape[1] and scale[1] != src.shape[0]:
+                src_r = cv2.resize(src, (scale[0], scale[1]), interpolation = cv2.INTER_LINEAR)
+                dst_r = cv2.resize(dst, (scale[0], scale[1]), interpolation=cv2.INTER_LINEAR)
+                scale = [scale[0] / src.shape[1], scale[1] / src.shape[0]]
+            else:
+                src_r, dst_r = src, dst
+                scale = None
+    else:
+        src_r, dst_r = src, dst
+
+    # Define 2x3 or 3x3 matrices and initialize the matrix to identity
+    if warp_mode == cv2.MOTION_HOMOGRAPHY :
+        warp_matrix = np.eye(3, 3, dtype=np.float32)
+    else :
+        warp_matrix = np.eye(2, 3, dtype=np.float32)
+
+    # Define termination criteria
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max_iter, eps)
+
+    # Run the ECC algorithm. The results are stored in warp_matrix.
+    try:
+        (cc, warp_matrix) = cv2.findTransformECC (src_r, dst_r, warp_matrix, warp_mode, criteria, None, 1)
+    except cv2.error as e:
+        return None, None
+    
+
+    if scale is not None:
+        warp_matrix[0, 2] = warp_matrix[0, 2] / scale[0]
+        warp_matrix[1, 2] = warp_matrix[1, 2] / scale[1]
+
+    if align:
+        sz = src.shape
+        if warp_mode == cv2.MOTION_HOMOGRAPHY:
+            # Use warpPerspective for Homography
+            src_aligned = cv2.warpPerspective(src, warp_matrix, (sz[1],sz[0]), flags=cv2.INTER_LINEAR)
+        else :
+            # Use warpAffine for Translation, Euclidean and Affine
+            src_aligned = cv2.warpAffine(src, warp_matrix, (sz[1],sz[0]), flags=cv2.INTER_LINEAR)
+        return warp_matrix, src_aligned
+    else:
+        return warp_matrix, None
+
+
+def get_matrix(matrix):
+    eye = np.eye(3)
+    dist = np.linalg.norm(eye - matrix)
+    if dist < 100:
+        return matrix
+    else:
+        return eye
+
+
+def camera_motion_matrix(previous_frame, next_frame):
+    """Estimate the camera motion between two frames as a 3x3 matrix.
+    The estimate only depends on the frame pair, so it is computed once per
+    frame and shared by all the tracks.
+    Returns
+    -------
+    ndarray | NoneType
+        The 3x3 warp matrix, or None if it could not be estimated.
+    """
+    warp_matrix, src_aligned = ECC(previous_frame, next_frame)
+    if warp_matrix is None and src_aligned is None:
+        return None
+    [a,b] = warp_matrix
+    warp_matrix=np.array([a,b,[0,0,1]])
+    return np.asarray(get_matrix(warp_matrix), dtype=np.float64)
+
+
+def warp_xyah(xyah, matrix):
+    """Apply a camera motion matrix to bounding boxes.
+    Parameters
+    ----------
+    xyah : ndarray
+        An Nx4 matrix of boxes in format `(center x, center y, aspect ratio, height)`.
+    matrix : ndarray
+        The 3x3 camera motion matrix.
+    Returns
+    -------
+    ndarray
+        The Nx4 warped boxes, the top left and bottom right corners of the
+        boxes are warped and the boxes are rebuilt from them.
+    """
+    w = xyah[:, 2] * xyah[:, 3]
+    h = xyah[:, 3]
+    x1 = xyah[:, 0] - w / 2
+    y1 = xyah[:, 1] - h / 2
+    ones = np.ones_like(x1)
+
+    # corners: 2xNx3 homogeneous coordinates of the top left and bottom right corners
+    corners = np.stack([np.stack([x1, y1, ones], axis=1), np.stack([x1 + w, y1 + h, ones], axis=1)])
+    warped = corners @ matrix.T
+    x1_, y1_ = warped[0, :, 0], warped[0, :, 1]
+    x2_, y2_ = warped[1, :, 0], warped[1, :, 1]
+    w, h = x2_ - x1_, y2_ - y1_
+    cx, cy = x1_ + w / 2, y1_ + h / 2
+    return np.stack([cx, cy, w / h, h], axis=1)
 
 
 class TrackState:
@@ -43,13 +194,18 @@ class Track:
     feature : Optional[ndarray]
         Feature vector of the detection this track originates from. If not None,
         this feature is added to the `features` cache.
+    kf : Optional[kalman_filter.BatchKalmanFilter]
+        The batched Kalman filter holding the state of the track. If None, the
+        track gets a filter of its own.
 
     Attributes
     ----------
     mean : ndarray
-        Mean vector of the initial state distribution.
+        Mean vector of the state distribution, a view of row `row` in `kf`.
     covariance : ndarray
-        Covariance matrix of the initial state distribution.
+        Covariance matrix of the state distribution, a view of row `row` in `kf`.
+    row : int
+        Index of the state of this track in `kf`.
     track_id : int
         A unique track identifier.
     hits : int
@@ -67,7 +223,7 @@ class Track:
     """
 
     def __init__(self, detection, track_id, class_id, conf, n_init, max_age, ema_alpha,
-                 feature=None):
+                 feature=None, kf=None):
         self.track_id = track_id
         self.class_id = int(class_id)
         self.hits = 1
@@ -85,8 +241,24 @@ class Track:
         self._n_init = n_init
         self._max_age = max_age
 
-        self.kf = KalmanFilter()
-        self.mean, self.covariance = self.kf.initiate(detection)
+        self.kf = kf if kf is not None else BatchKalmanFilter(capacity=1)
+        self.row = self.kf.add(detection)
+
+    @property
+    def mean(self):
+        return self.kf.means[self.row]
+
+    @mean.setter
+    def mean(self, mean):
+        self.kf.means[self.row] = mean
+
+    @property
+    def covariance(self):
+        return self.kf.covariances[self.row]
+
+    @covariance.setter
+    def covariance(self, covariance):
+        self.kf.covariances[self.row] = covariance
 
     def to_tlwh(self):
         """Get current position in bounding box format `(top left x, top left y,
@@ -118,142 +290,21 @@ class Track:
         return ret
 
 
-    def ECC(self, src, dst, warp_mode = cv2.MOTION_EUCLIDEAN, eps = 1e-5,
-        max_iter = 100, scale = 0.1, align = False):
-        """Compute the warp matrix from src to dst.
-        Parameters
-        ----------
-        src : ndarray 
-            An NxM matrix of source img(BGR or Gray), it must be the same format as dst.
-        dst : ndarray
-            An NxM matrix of target img(BGR or Gray).
-        warp_mode: flags of opencv
-            translation: cv2.MOTION_TRANSLATION
-            rotated and shifted: cv2.MOTION_EUCLIDEAN
-            affine(shift,rotated,shear): cv2.MOTION_AFFINE
-            homography(3d): cv2.MOTION_HOMOGRAPHY
-        eps: float
-            the threshold of the increment in the correlation coefficient between two iterations
-        max_iter: int
-            the number of iterations.
-        scale: float or [int, int]
-            scale_ratio: float
-            scale_size: [W, H]
-        align: bool
-            whether to warp affine or perspective transforms to the source image
-        Returns
-        -------
-        warp matrix : ndarray
-            Returns the warp matrix from src to dst.
-            if motion models is homography, the warp matrix will be 3x3, otherwise 2x3
-        src_aligned: ndarray
-            aligned source image of gray
-        """
-        assert src.shape == dst.shape, "the source image must be the same format to the target image!"
-        
-        if src.any() or dst.any() is None: 
-            return None, None
-
-        # BGR2GRAY
-        if src.ndim == 3:
-            # Convert images to grayscale
-            src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
-            dst = cv2.cvtColor(dst, cv2.COLOR_BGR2GRAY)
-
-        # make the imgs smaller to speed up
-        if scale is not None:
-            if isinstance(scale, float) or isinstance(scale, int):
-                if scale != 1:
-                    src_r = cv2.resize(src, (0, 0), fx = scale, fy = scale,interpolation =  cv2.INTER_LINEAR)
-                    dst_r = cv2.resize(dst, (0, 0), fx = scale, fy = scale,interpolation =  cv2.INTER_LINEAR)
-                    scale = [scale, scale]
-                else:
-                    src_r, dst_r = src, dst
-                    scale = None
-            else:
-                if scale[0] != src.shape[1] and scale[1] != src.shape[0]:
-                    src_r = cv2.resize(src, (scale[0], scale[1]), interpolation = cv2.INTER_LINEAR)
-                    dst_r = cv2.resize(dst, (scale[0], scale[1]), interpolation=cv2.INTER_LINEAR)
-                    scale = [scale[0] / src.shape[1], scale[1] / src.shape[0]]
-                else:
-                    src_r, dst_r = src, dst
-                    scale = None
-        else:
-            src_r, dst_r = src, dst
-
-        # Define 2x3 or 3x3 matrices and initialize the matrix to identity
-        if warp_mode == cv2.MOTION_HOMOGRAPHY :
-            warp_matrix = np.eye(3, 3, dtype=np.float32)
-        else :
-            warp_matrix = np.eye(2, 3, dtype=np.float32)
-
-        # Define termination criteria
-        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max_iter, eps)
-
-        # Run the ECC algorithm. The results are stored in warp_matrix.
-        try:
-            (cc, warp_matrix) = cv2.findTransformECC (src_r, dst_r, warp_matrix, warp_mode, criteria, None, 1)
-        except cv2.error as e:
-            return None, None
-        
-
-        if scale is not None:
-            warp_matrix[0, 2] = warp_matrix[0, 2] / scale[0]
-            warp_matrix[1, 2] = warp_matrix[1, 2] / scale[1]
-
-        if align:
-            sz = src.shape
-            if warp_mode == cv2.MOTION_HOMOGRAPHY:
-                # Use warpPerspective for Homography
-                src_aligned = cv2.warpPerspective(src, warp_matrix, (sz[1],sz[0]), flags=cv2.INTER_LINEAR)
-            else :
-                # Use warpAffine for Translation, Euclidean and Affine
-                src_aligned = cv2.warpAffine(src, warp_matrix, (sz[1],sz[0]), flags=cv2.INTER_LINEAR)
-            return warp_matrix, src_aligned
-        else:
-            return warp_matrix, None
-
-
-    def get_matrix(self, matrix):
-        eye = np.eye(3)
-        dist = np.linalg.norm(eye - matrix)
-        if dist < 100:
-            return matrix
-        else:
-            return eye
-
     def camera_update(self, previous_frame, next_frame):
-        warp_matrix, src_aligned = self.ECC(previous_frame, next_frame)
-        if warp_matrix is None and src_aligned is None:
+        matrix = camera_motion_matrix(previous_frame, next_frame)
+        if matrix is None:
             return
-        [a,b] = warp_matrix
-        warp_matrix=np.array([a,b,[0,0,1]])
-        warp_matrix = warp_matrix.tolist()
-        matrix = self.get_matrix(warp_matrix)
-
-        x1, y1, x2, y2 = self.to_tlbr()
-        x1_, y1_, _ = matrix @ np.array([x1, y1, 1]).T
-        x2_, y2_, _ = matrix @ np.array([x2, y2, 1]).T
-        w, h = x2_ - x1_, y2_ - y1_
-        cx, cy = x1_ + w / 2, y1_ + h / 2
-        self.mean[:4] = [cx, cy, w / h, h]
-
+        self.mean[:4] = warp_xyah(self.mean[None, :4], matrix)[0]
 
     def increment_age(self):
         self.age += 1
         self.time_since_update += 1
 
-    def predict(self, kf):
+    def predict(self):
         """Propagate the state distribution to the current time step using a
-        Kalman filter prediction step.
-
-        Parameters
-        ----------
-        kf : kalman_filter.KalmanFilter
-            The Kalman filter.
-
+        Kalman filter prediction step of the filter `kf` holding this track.
         """
-        self.mean, self.covariance = self.kf.predict(self.mean, self.covariance)
+        self.kf.predict_rows([self.row])
         self.age += 1
         self.time_since_update += 1
 
@@ -265,9 +316,15 @@ class Track:
         detection : Detection
             The associated detection.
         """
+        self.kf.update_rows([self.row], detection.to_xyah()[None], [detection.confidence])
+        self.register_update(detection, class_id, conf)
+
+    def register_update(self, detection, class_id, conf):
+        """Update the feature cache and the track state once the Kalman filter
+        correction of this track has been run, e.g. in a batch by the tracker.
+        """
         self.conf = conf
         self.class_id = class_id.int()
-        self.mean, self.covariance = self.kf.update(self.mean, self.covariance, detection.to_xyah(), detection.confidence)
 
         feature = detection.feature / np.linalg.norm(detection.feature)
 
@@ -4,7 +4,7 @@ import numpy as np
 from . import kalman_filter
 from . import linear_assignment
 from . import iou_matching
-from .track import Track
+from .track import Track, camera_motion_matrix, warp_xyah
 
 
 class Tracker:
@@ -28,8 +28,9 @@ class Tracker:
         Maximum number of missed misses before a track is deleted.
     n_init : int
         Number of frames that a track remains in initialization phase.
-    kf : kalman_filter.KalmanFilter
-        A Kalman filter to filter target trajectories in image space.
+    kf : kalman_filter.BatchKalmanFilter
+        A Kalman filter to filter target trajectories in image space. It holds
+        the states of all tracks and runs each step on all of them at once.
     tracks : List[Track]
         The list of active tracks at the current time step.
     """
@@ -44,7 +45,7 @@ class Tracker:
         self.ema_alpha = ema_alpha
         self.mc_lambda = mc_lambda
 
-        self.kf = kalman_filter.KalmanFilter()
+        self.kf = kalman_filter.BatchKalmanFilter()
         self.tracks = []
         self._next_id = 1
 
@@ -53,8 +54,17 @@ class Tracker:
 
         This function should be called once every time step, before `update`.
         """
+        self.kf.predict_rows([track.row for track in self.tracks])
         for track in self.tracks:
-            track.predict(self.kf)
+            track.increment_age()
+
+    def predict_skipped(self):
+        """Propagate track state distributions over a frame on which detection was skipped.
+
+        Unlike `predict`, the frame does not count as a missed update, so tracks
+        keep their matching state until the next frame with detections.
+        """
+        self.kf.predict_rows([track.row for track in self.tracks])
 
     def increment_ages(self):
         for track in self.tracks:
@@ -62,8 +72,18 @@ class Tracker:
             track.mark_missed()
 
     def camera_update(self, previous_img, current_img):
-        for track in self.tracks:
-            track.camera_update(previous_img, current_img)
+        """Compensate the camera motion between two frames for all tracks.
+
+        The warp is estimated once for the frame pair and applied to the
+        means of all tracks in a single matrix multiplication.
+        """
+        if not self.tracks or previous_img is None:
+            return
+        matrix = camera_motion_matrix(previous_img, current_img)
+        if matrix is None:
+            return
+        rows = [track.row for track in self.tracks]
+        self.kf.means[rows, :4] = warp_xyah(self.kf.means[rows, :4], matrix)
 
     def update(self, detections, classes, confidences):
         """Perform measurement update and track management.
@@ -78,15 +98,23 @@ class Tracker:
         matches, unmatched_tracks, unmatched_detections = \
             self._match(detections)
 
-        # Update track set.
+        # Update track set, the Kalman filter corrections run in a single batch.
+        if matches:
+            self.kf.update_rows(
+                [self.tracks[track_idx].row for track_idx, _ in matches],
+                np.asarray([detections[detection_idx].to_xyah() for _, detection_idx in matches]),
+                np.asarray([detections[detection_idx].confidence for _, detection_idx in matches]))
         for track_idx, detection_idx in matches:
-            self.tracks[track_idx].update(
+            self.tracks[track_idx].register_update(
                 detections[detection_idx], classes[detection_idx], confidences[detection_idx])
         for track_idx in unmatched_tracks:
             self.tracks[track_idx].mark_missed()
         for detection_idx in unmatched_detections:
             self._initiate_track(detections[detection_idx], classes[detection_idx].item(), confidences[detection_idx].item())
         self.tracks = [t for t in self.tracks if not t.is_deleted()]
+        self.kf.compact([t.row for t in self.tracks])
+        for row, track in enumerate(self.tracks):
+            track.row = row
 
         # Update distance metric.
         active_targets = [t.track_id for t in self.tracks if t.is_confirmed()]
@@ -111,14 +139,9 @@ class Tracker:
         is more intuitive in terms of values.
         """
         # Compute First the Position-based Cost Matrix
-        pos_cost = np.empty([len(track_indices), len(detection_indices)])
         msrs = np.asarray([dets[i].to_xyah() for i in detection_indices])
-        for row, track_idx in enumerate(track_indices):
-            pos_cost[row, :] = np.sqrt(
-                self.kf.gating_distance(
-                    tracks[track_idx].mean, tracks[track_idx].covariance, msrs, False
-                )
-            ) / self.GATING_THRESHOLD
+        rows = [tracks[track_idx].row for track_idx in track_indices]
+        pos_cost = np.sqrt(self.kf.gating_distance_rows(rows, msrs, False)) / self.GATING_THRESHOLD
         pos_gate = pos_cost > 1.0
         # Now Compute the Appearance-based Cost Matrix
         app_cost = self.metric.distance(
@@ -173,5 +196,5 @@ class Tracker:
     def _initiate_track(self, detection, class_id, conf):
         self.tracks.append(Track(
             detection.to_xyah(), self._next_id, class_id, conf, self.n_init, self.max_age, self.ema_alpha,
-            detection.feature))
+            detection.feature, kf=self.kf))
         self._next_id += 1
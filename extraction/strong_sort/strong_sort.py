@@ -38,8 +38,9 @@ class StrongSORT(object):
         self.extractor = FeatureExtractor(
             # get rid of dataset information DeepSort model name
             model_name=model_name,
-            model_path=model_weights,
-            device=str(device)
+            model_path=str(model_weights),
+            device=str(device),
+            verbose=False
         )
 
         self.max_dist = max_dist
@@ -63,7 +64,15 @@ class StrongSORT(object):
         # update tracker
         self.tracker.predict()
         self.tracker.update(detections, classes, confidences)
+        return self._outputs()
 
+    def predict_tracks(self, ori_img):
+        """Kalman prediction of the tracks on a frame without detections, e.g. between two detection frames"""
+        self.height, self.width = ori_img.shape[:2]
+        self.tracker.predict_skipped()
+        return self._outputs()
+
+    def _outputs(self):
         # output bbox identities
         outputs = []
         for track in self.tracker.tracks:
@@ -130,13 +139,9 @@ class StrongSORT(object):
         return t, l, w, h
 
     def _get_features(self, bbox_xywh, ori_img):
-        im_crops = []
-        for box in bbox_xywh:
-            x1, y1, x2, y2 = self._xywh_to_xyxy(box)
-            im = ori_img[y1:y2, x1:x2]
-            im_crops.append(im)
-        if im_crops:
-            features = self.extractor(im_crops)
+        boxes = [self._xywh_to_xyxy(box) for box in bbox_xywh]
+        if boxes:
+            features = self.extractor.extract_boxes(ori_img, np.array(boxes, dtype=np.float32))
         else:
             features = np.array([])
         return features
@@ -4,6 +4,7 @@ from functools import total_ordering
 import os
 
 import sys
+from itertools import chain, islice
 # import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
@@ -32,6 +33,9 @@ from yolov5.utils.torch_utils import select_device, time_sync
 from yolov5.utils.plots import Annotator, colors, save_one_box
 from extraction.strong_sort.utils.parser import get_config
 from extraction.strong_sort import StrongSORT
+from extraction.tracks_file import BufferedTracksWriter, TRACKS_SUFFIX
+from extraction.pipeline import Stage, StageStats, batched
+from extraction.motion_gate import MotionGate, SKIP_STATIC, SKIP_STRIDE
 
 # remove duplicated stream handler to avoid duplicated logging
 try:
@@ -53,6 +57,7 @@ def run(
         device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
         show_vid=False,  # show results
         save_txt=True,  # save results to *.txt
+        save_tracks_binary=False,  # save results to a binary tracks file instead of *.txt
         save_conf=False,  # save confidences in --save-txt labels
         save_crop=False,  # save cropped prediction boxes
         save_vid=False,  # save confidences in --save-txt labels
@@ -71,7 +76,14 @@ def run(
         hide_class=False,  # hide IDs
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
-        threads=1  # threads to use
+        threads=1,  # threads to use
+        queue_depth=4,  # frames buffered between the decode, detection and tracking stages
+        batch_size=1,  # frames per YOLO forward pass for video files and image folders
+        detect_stride=1,  # run detection every detect_stride frames, tracks are predicted in between
+        motion_thres=0.0,  # skip detection when less than this fraction of pixels changed, 0 to disable
+        start_frame=0,  # first frame to process in a video file, frames are still numbered from the video start
+        end_frame=None,  # frame to stop before in a video file, None for the end of the video
+        frame_sinks=None  # objects given every frame and its tracks through add_frame(frame, image, outputs)
 ):
     os.environ["OMP_NUM_THREADS"] = str(threads)
     os.environ["OPENBLAS_NUM_THREADS"] = str(threads)
@@ -113,6 +125,15 @@ def run(
     else:
         dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt)
         nr_sources = 1
+    if start_frame or end_frame is not None:
+        assert not webcam and is_file, "A frame range can only be given for a video file"
+        dataset.cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        dataset.frame = start_frame
+    frame_sinks = frame_sinks or []
+    assert not (frame_sinks and webcam), "Frame sinks are only supported for a single video or folder"
+    # Streams are already batched over sources, and exported models other than PyTorch
+    # may have a fixed batch size, so only offline sources with a PyTorch model are batched
+    batch_size = batch_size if pt and not webcam else 1
     vid_path, vid_writer, txt_path = [None] * nr_sources, [None] * nr_sources, [None] * nr_sources
 
     # initialize StrongSORT
@@ -137,147 +158,221 @@ def run(
             )
         )
     outputs = [None] * nr_sources
+    tracks_writers = {}  # one buffered writer per tracks file
+
+    motion_gate = MotionGate(detect_stride=detect_stride, motion_thres=motion_thres)
+
+    def decode(item):
+        # Runs in the decode thread right after the dataset decoded and letterboxed the frame,
+        # so the dataset counters still describe this frame when the tracking stage gets it
+        path, im, im0s, vid_cap, s = item
+        counters = getattr(dataset, 'count', 0), getattr(dataset, 'frame', 0), getattr(dataset, 'frames', 0)
+        skip = motion_gate.skip_reason(im0s if webcam else [im0s])
+        return path, torch.from_numpy(im), im0s, vid_cap, s, counters, skip
+
+    @torch.no_grad()  # grad mode is per thread
+    def detect(items):
+        # items is a batch of frames with the same shape, results are given back frame by frame
+        if items[0][-1] is not None:  # frames skipped by the motion gate
+            return [(path, im.shape if im.dim() == 4 else (1, *im.shape), im0s, vid_cap, s, counters,
+                     [None] * nr_sources, (0.0, 0.0, 0.0), skip)
+                    for path, im, im0s, vid_cap, s, counters, skip in items]
 
-    # Run tracking
-    model.warmup(imgsz=(1 if pt else nr_sources, 3, *imgsz))  # warmup
-    dt, seen = [0.0, 0.0, 0.0, 0.0], 0
-    curr_frames, prev_frames = [None] * nr_sources, [None] * nr_sources
-    for frame_idx, (path, im, im0s, vid_cap, s) in enumerate(dataset):
         t1 = time_sync()
-        im = torch.from_numpy(im).to(device)
+        ims = [item[1] for item in items]
+        im = torch.stack(ims) if len(ims) > 1 else ims[0]
+        im = im.to(device)
         im = im.half() if half else im.float()  # uint8 to fp16/32
         im /= 255.0  # 0 - 255 to 0.0 - 1.0
         if len(im.shape) == 3:
             im = im[None]  # expand for batch dim
         t2 = time_sync()
-        dt[0] += t2 - t1
 
         # Inference
-        visualize = increment_path(save_dir / Path(path[0]).stem, mkdir=True) if visualize else False
-        pred = model(im, augment=augment, visualize=visualize)
+        visualize_path = increment_path(save_dir / Path(items[0][0][0]).stem, mkdir=True) if visualize else False
+        pred = model(im, augment=augment, visualize=visualize_path)
         t3 = time_sync()
-        dt[1] += t3 - t2
 
         # Apply NMS
         pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
-        dt[2] += time_sync() - t3
-
-        # Process detections
-        for i, det in enumerate(pred):  # detections per image
-            seen += 1
-            if webcam:  # nr_sources >= 1
-                p, im0, _ = path[i], im0s[i].copy(), dataset.count
-                p = Path(p)  # to Path
-                s += f'{i}: '
-                txt_file_name = p.name
-                save_path = str(save_dir / p.name)  # im.jpg, vid.mp4, ...
-            else:
-                p, im0, _ = path, im0s.copy(), getattr(dataset, 'frame', 0)
-                p = Path(p)  # to Path
-                # video file
-                if source.endswith(VID_FORMATS):
-                    txt_file_name = p.stem
+        t4 = time_sync()
+
+        if len(items) > 1:
+            pred = [[det] for det in pred]  # one frame per item, as for an unbatched image
+        else:
+            pred = [pred]
+        times = tuple(t / len(items) for t in (t2 - t1, t3 - t2, t4 - t3))
+        return [(path, im.shape, im0s, vid_cap, s, counters, det, times, None)
+                for (path, _, im0s, vid_cap, s, counters, _), det in zip(items, pred)]
+
+    # Run tracking: decoding and detection run in background threads, tracking runs here in frame order
+    model.warmup(imgsz=(1 if pt else nr_sources, 3, *imgsz))  # warmup
+    dt, seen = [0.0, 0.0, 0.0, 0.0], 0
+    curr_frames, prev_frames = [None] * nr_sources, [None] * nr_sources
+    frames = dataset if end_frame is None else islice(dataset, end_frame - start_frame)
+    decode_stage = Stage('decode', frames, decode, maxsize=queue_depth)
+    batches = batched(decode_stage, batch_size, key=lambda item: (item[1].shape, item[-1]))
+    detect_stage = Stage('detect', batches, detect, maxsize=max(queue_depth // batch_size, 1))
+    track_stats = StageStats('track')
+    try:
+        frames = chain.from_iterable(detect_stage)  # batches of detections back to single frames
+        for frame_idx, (path, im_shape, im0s, vid_cap, s, counters, pred, times, skip) in enumerate(frames):
+            t_track = time_sync()
+            count, frame, nframes = counters
+            dt[0] += times[0]
+            dt[1] += times[1]
+            dt[2] += times[2]
+
+            # Process detections
+            for i, det in enumerate(pred):  # detections per image
+                seen += 1
+                frame_outputs = []  # tracks written for this frame
+                if webcam:  # nr_sources >= 1
+                    p, im0, _ = path[i], im0s[i].copy(), count
+                    p = Path(p)  # to Path
+                    s += f'{i}: '
+                    txt_file_name = p.name
                     save_path = str(save_dir / p.name)  # im.jpg, vid.mp4, ...
-                # folder with imgs
                 else:
-                    txt_file_name = p.parent.name  # get folder name containing current img
-                    save_path = str(save_dir / p.parent.name)  # im.jpg, vid.mp4, ...
-            curr_frames[i] = im0
-
-            txt_path = str(save_dir / 'tracks' / txt_file_name)  # im.txt
-            s += '%gx%g ' % im.shape[2:]  # print string
-            imc = im0.copy() if save_crop else im0  # for save_crop
-
-            annotator = Annotator(im0, line_width=2, pil=not ascii)
-            if cfg.STRONGSORT.ECC:  # camera motion compensation
-                strongsort_list[i].tracker.camera_update(prev_frames[i], curr_frames[i])
-
-            if det is not None and len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
-
-                # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                xywhs = xyxy2xywh(det[:, 0:4])
-                confs = det[:, 4]
-                clss = det[:, 5]
-
-                # pass detections to strongsort
-                t4 = time_sync()
-                outputs[i] = strongsort_list[i].update(xywhs.cpu(), confs.cpu(), clss.cpu(), im0)
-                t5 = time_sync()
-                dt[3] += t5 - t4
-
-                # draw boxes for visualization
-                if len(outputs[i]) > 0:
-                    for j, (output, conf) in enumerate(zip(outputs[i], confs)):
-
-                        bboxes = output[0:4]
-                        id = output[4]
-                        cls = output[5]
-
-                        if save_txt:
-                            # to MOT format
-                            bbox_left = output[0]
-                            bbox_top = output[1]
-                            bbox_w = output[2] - output[0]
-                            bbox_h = output[3] - output[1]
-                            # Write MOT compliant results to file
-                            with open(txt_path + '.txt', 'a') as f:
-                                f.write(('%g ' * 10 + '\n') % (frame_idx + 1, id, bbox_left,  # MOT format
-                                                               bbox_top, bbox_w, bbox_h, -1, -1, -1, i))
-
-                        if save_vid or save_crop or show_vid:  # Add bbox to image
-                            c = int(cls)  # integer class
-                            id = int(id)  # integer id
-                            label = None if hide_labels else (f'{id} {names[c]}' if hide_conf else \
-                                                                  (
-                                                                      f'{id} {conf:.2f}' if hide_class else f'{id} {names[c]} {conf:.2f}'))
-                            annotator.box_label(bboxes, label, color=colors(c, True))
-                            if save_crop:
-                                txt_file_name = txt_file_name if (isinstance(path, list) and len(path) > 1) else ''
-                                save_one_box(bboxes, imc, file=save_dir / 'crops' / txt_file_name / names[
-                                    c] / f'{id}' / f'{p.stem}.jpg', BGR=True)
-
-                print(f'{s}Done. YOLO:({t3 - t2:.3f}s), StrongSORT:({t5 - t4:.3f}s)')
-
-            else:
-                strongsort_list[i].increment_ages()
-                print(f'video {dataset.count + 1}/{dataset.nf} ({frame_idx}/{dataset.frames}) - No detections')
-
-            # Stream results
-            im0 = annotator.result()
-            if show_vid:
-                cv2.imshow(str(p), im0)
-                cv2.waitKey(1)  # 1 millisecond
-
-            # Save results (image with detections)
-            if save_vid:
-                if vid_path[i] != save_path:  # new video
-                    vid_path[i] = save_path
-                    if isinstance(vid_writer[i], cv2.VideoWriter):
-                        vid_writer[i].release()  # release previous video writer
-                    if vid_cap:  # video
-                        fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                        w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                        h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                    else:  # stream
-                        fps, w, h = 30, im0.shape[1], im0.shape[0]
-                    save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                    vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                vid_writer[i].write(im0)
-
-            prev_frames[i] = curr_frames[i]
+                    p, im0, _ = path, im0s.copy(), frame
+                    p = Path(p)  # to Path
+                    # video file
+                    if source.endswith(VID_FORMATS):
+                        txt_file_name = p.stem
+                        save_path = str(save_dir / p.name)  # im.jpg, vid.mp4, ...
+                    # folder with imgs
+                    else:
+                        txt_file_name = p.parent.name  # get folder name containing current img
+                        save_path = str(save_dir / p.parent.name)  # im.jpg, vid.mp4, ...
+                curr_frames[i] = im0
+
+                txt_path = str(save_dir / 'tracks' / txt_file_name)  # im.txt
+                s += '%gx%g ' % im_shape[2:]  # print string
+                imc = im0.copy() if save_crop else im0  # for save_crop
+
+                annotator = Annotator(im0, line_width=2, pil=not ascii)
+                if cfg.STRONGSORT.ECC:  # camera motion compensation
+                    strongsort_list[i].tracker.camera_update(prev_frames[i], curr_frames[i])
+
+                if det is not None and len(det):
+                    # Rescale boxes from img_size to im0 size
+                    det[:, :4] = scale_coords(im_shape[2:], det[:, :4], im0.shape).round()
+
+                    # Print results
+                    for c in det[:, -1].unique():
+                        n = (det[:, -1] == c).sum()  # detections per class
+                        s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+
+                    xywhs = xyxy2xywh(det[:, 0:4])
+                    confs = det[:, 4]
+                    clss = det[:, 5]
+
+                    # pass detections to strongsort
+                    t4 = time_sync()
+                    outputs[i] = frame_outputs = strongsort_list[i].update(xywhs.cpu(), confs.cpu(), clss.cpu(), im0)
+                    t5 = time_sync()
+                    dt[3] += t5 - t4
+
+                    if save_txt:
+                        # Write MOT compliant results to file
+                        if txt_path not in tracks_writers:
+                            tracks_writers[txt_path] = BufferedTracksWriter(txt_path, binary=save_tracks_binary)
+                        tracks_writers[txt_path].write_outputs(start_frame + frame_idx + 1, outputs[i], i)
+
+                    # draw boxes for visualization
+                    if len(outputs[i]) > 0:
+                        for j, (output, conf) in enumerate(zip(outputs[i], confs)):
+
+                            bboxes = output[0:4]
+                            id = output[4]
+                            cls = output[5]
+
+                            if save_vid or save_crop or show_vid:  # Add bbox to image
+                                c = int(cls)  # integer class
+                                id = int(id)  # integer id
+                                label = None if hide_labels else (f'{id} {names[c]}' if hide_conf else \
+                                                                      (
+                                                                          f'{id} {conf:.2f}' if hide_class else f'{id} {names[c]} {conf:.2f}'))
+                                annotator.box_label(bboxes, label, color=colors(c, True))
+                                if save_crop:
+                                    txt_file_name = txt_file_name if (isinstance(path, list) and len(path) > 1) else ''
+                                    save_one_box(bboxes, imc, file=save_dir / 'crops' / txt_file_name / names[
+                                        c] / f'{id}' / f'{p.stem}.jpg', BGR=True)
+
+                    print(f'{s}Done. YOLO:({times[1]:.3f}s), StrongSORT:({t5 - t4:.3f}s), '
+                          f'queued: {decode_stage.queue.qsize()} decoded, {detect_stage.queue.qsize()} detected')
+
+                elif skip == SKIP_STRIDE:
+                    # Fill the frames between two detections with the Kalman prediction of the tracks
+                    outputs[i] = frame_outputs = strongsort_list[i].predict_tracks(im0)
+                    if save_txt:
+                        if txt_path not in tracks_writers:
+                            tracks_writers[txt_path] = BufferedTracksWriter(txt_path, binary=save_tracks_binary)
+                        tracks_writers[txt_path].write_outputs(start_frame + frame_idx + 1, outputs[i], i)
+
+                elif skip == SKIP_STATIC:
+                    # Nothing moved since the last detected frame, the tracks stay where they were
+                    strongsort_list[i].increment_ages()
+                    frame_outputs = outputs[i] if outputs[i] is not None else []
+                    if save_txt and len(frame_outputs):
+                        if txt_path not in tracks_writers:
+                            tracks_writers[txt_path] = BufferedTracksWriter(txt_path, binary=save_tracks_binary)
+                        tracks_writers[txt_path].write_outputs(start_frame + frame_idx + 1, frame_outputs, i)
+                    print(f'video {count + 1}/{dataset.nf} ({frame_idx}/{nframes}) - Static frame')
+
+                else:
+                    outputs[i] = []
+                    strongsort_list[i].increment_ages()
+                    print(f'video {count + 1}/{dataset.nf} ({frame_idx}/{nframes}) - No detections')
+
+                # Stream results
+                im0 = annotator.result()
+                if show_vid:
+                    cv2.imshow(str(p), im0)
+                    cv2.waitKey(1)  # 1 millisecond
+
+                # Save results (image with detections)
+                if save_vid:
+                    if vid_path[i] != save_path:  # new video
+                        vid_path[i] = save_path
+                        if isinstance(vid_writer[i], cv2.VideoWriter):
+                            vid_writer[i].release()  # release previous video writer
+                        if vid_cap:  # video
+                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
+                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                        else:  # stream
+                            fps, w, h = 30, im0.shape[1], im0.shape[0]
+                        save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
+                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                    vid_writer[i].write(im0)
+
+                # Hand the undrawn frame over to the sinks, e.g. to crop patches or update the background
+                for frame_sink in frame_sinks:
+                    frame_sink.add_frame(start_frame + frame_idx + 1, im0s, frame_outputs)
+
+                prev_frames[i] = curr_frames[i]
+            track_stats.items += 1
+            track_stats.work_time += time_sync() - t_track
+    finally:
+        detect_stage.stop()
+        decode_stage.stop()
+        # Also on errors, so that the rows and patches of the frames tracked so far are written
+        for tracks_writer in tracks_writers.values():
+            tracks_writer.close()
+        for frame_sink in frame_sinks:
+            frame_sink.close()
 
     # Print results
     t = tuple(x / seen * 1E3 for x in dt)  # speeds per image
     print(
         f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS, %.1fms strong sort update per image at shape {(1, 3, *imgsz)}' % t)
+    for stats in (decode_stage.stats, detect_stage.stats, track_stats):
+        print(stats)
     if save_txt or save_vid:
-        s = f"\n{len(list(save_dir.glob('tracks/*.txt')))} tracks saved to {save_dir / 'tracks'}" if save_txt else ''
+        tracks_suffix = TRACKS_SUFFIX if save_tracks_binary else '.txt'
+        s = f"\n{len(list(save_dir.glob('tracks/*' + tracks_suffix)))} tracks saved to {save_dir / 'tracks'}" if save_txt else ''
         print(f"Results saved to {colorstr('bold', save_dir)}{s}")
     if update:
         strip_optimizer(yolo_weights)  # update model (to fix SourceChangeWarning)
+    return decode_stage.stats, detect_stage.stats, track_stats
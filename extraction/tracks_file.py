@@ -0,0 +1,176 @@
+"""
+Binary columnar format for tracker output, used between extraction and aggregation.
+A tracks file is a fixed size header followed by rows of int32 values
+frame, tag, x, y, w, h, sorted by frame so that readers can memory-map the file
+and take a range of frames without decoding the rest of it.
+Header: magic (8 bytes), version (uint32), number of columns (uint32), number of rows (uint64), padding.
+"""
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+TRACKS_MAGIC = b'DGVSTRK\x00'
+TRACKS_VERSION = 1
+TRACKS_COLUMNS = ('frame', 'tag', 'x', 'y', 'w', 'h')
+TRACKS_DTYPE = np.dtype('<i4')
+TRACKS_HEADER_SIZE = 32
+TRACKS_SUFFIX = '.tracks'
+_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('ncols', '<u4'), ('nrows', '<u8'), ('pad', 'V8')])
+
+
+def pack_tracks_header(nrows):
+    header = np.zeros(1, dtype=_HEADER_DTYPE)
+    header['magic'] = TRACKS_MAGIC
+    header['version'] = TRACKS_VERSION
+    header['ncols'] = len(TRACKS_COLUMNS)
+    header['nrows'] = nrows
+    return header.tobytes()
+
+
+def unpack_tracks_header(buffer):
+    """
+    Parse and check the header of a tracks file, returns the number of rows
+    """
+    header = np.frombuffer(buffer[:TRACKS_HEADER_SIZE], dtype=_HEADER_DTYPE)[0]
+    if header['magic'] != TRACKS_MAGIC.rstrip(b'\x00'):
+        raise ValueError("Not a tracks file: wrong magic number")
+    if header['version'] != TRACKS_VERSION:
+        raise ValueError(f"Unsupported tracks file version {header['version']}, expected {TRACKS_VERSION}")
+    if header['ncols'] != len(TRACKS_COLUMNS):
+        raise ValueError(f"Expected {len(TRACKS_COLUMNS)} columns in tracks file but got {header['ncols']}")
+    return int(header['nrows'])
+
+
+class TracksWriter:
+    """
+    Append rows of frame, tag, x, y, w, h to a tracks file block by block.
+    Rows must come in non-decreasing frame order. The number of rows in the header
+    is written on close, so the writer should be closed or used as a context manager.
+    """
+
+    def __init__(self, tracks_path):
+        self.tracks_path = tracks_path
+        self.nrows = 0
+        self.last_frame = None
+        self.file = open(tracks_path, 'wb')
+        self.file.write(pack_tracks_header(0))
+
+    def write(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=TRACKS_DTYPE).reshape(-1, len(TRACKS_COLUMNS))
+        if not len(rows):
+            return
+        frames = rows[:, 0]
+        assert (self.last_frame is None or frames[0] >= self.last_frame) and np.all(frames[1:] >= frames[:-1]), \
+            "Expected rows sorted by frame in tracks file"
+        rows.tofile(self.file)
+        self.nrows += len(rows)
+        self.last_frame = frames[-1]
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.seek(0)
+        self.file.write(pack_tracks_header(self.nrows))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_tracks_file(tracks_path, frames, tags, boxes):
+    """
+    Write detections given as frames (N,), tags (N,) and boxes (N, 4) of x, y, w, h to a tracks file
+    """
+    rows = np.column_stack((frames, tags, boxes)).astype(TRACKS_DTYPE)
+    rows = rows[np.argsort(rows[:, 0], kind='stable')]
+    with TracksWriter(tracks_path) as writer:
+        writer.write(rows)
+    return tracks_path
+
+
+def load_tracks(tracks_path, start_frame=None, end_frame=None):
+    """
+    Memory-map a tracks file and return the (N, 6) rows of frame, tag, x, y, w, h
+    whose frame is in [start_frame, end_frame]. Only the pages holding
+    those frames are read from disk.
+    """
+    with open(tracks_path, 'rb') as f:
+        nrows = unpack_tracks_header(f.read(TRACKS_HEADER_SIZE))
+    if nrows == 0:
+        return np.empty((0, len(TRACKS_COLUMNS)), dtype=TRACKS_DTYPE)
+    rows = np.memmap(tracks_path, dtype=TRACKS_DTYPE, mode='r', offset=TRACKS_HEADER_SIZE,
+                     shape=(nrows, len(TRACKS_COLUMNS)))
+
+    # Binary search on the frame column, np.searchsorted would copy the whole column
+    frames = rows[:, 0]
+    start = 0 if start_frame is None else bisect_left(frames, start_frame)
+    end = nrows if end_frame is None else bisect_right(frames, end_frame)
+    return rows[start:end]
+
+
+class BufferedTracksWriter:
+    """
+    Keep one open file per tracker output and accumulate MOT rows
+    frame, id, left, top, w, h, -1, -1, -1, source in a NumPy buffer,
+    flushing it in blocks either as MOT text lines or into a binary tracks file.
+    """
+    MOT_COLUMNS = 10
+
+    def __init__(self, txt_path, binary=False, block_size=4096):
+        self.binary = binary
+        self.path = txt_path + (TRACKS_SUFFIX if binary else '.txt')
+        self.buffer = np.empty((block_size, self.MOT_COLUMNS), dtype=np.float64)
+        self.size = 0
+        if binary:
+            self.writer = TracksWriter(self.path)
+        else:
+            self.writer = open(self.path, 'a')
+
+    def write_outputs(self, frame, outputs, source):
+        """
+        Buffer the StrongSORT outputs (x1, y1, x2, y2, id, class, conf) of a frame in MOT format
+        """
+        if not len(outputs):
+            return
+        outputs = np.asarray(outputs, dtype=np.float64)
+        rows = np.empty((len(outputs), self.MOT_COLUMNS), dtype=np.float64)
+        rows[:, 0] = frame
+        rows[:, 1] = outputs[:, 4]
+        rows[:, 2:4] = outputs[:, 0:2]
+        rows[:, 4:6] = outputs[:, 2:4] - outputs[:, 0:2]
+        rows[:, 6:9] = -1
+        rows[:, 9] = source
+        self.write(rows)
+
+    def write(self, rows):
+        if self.size + len(rows) > len(self.buffer):
+            self.flush()
+            if len(rows) > len(self.buffer):
+                self._write_block(rows)
+                return
+        self.buffer[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+    def _write_block(self, rows):
+        if self.binary:
+            self.writer.write(rows[:, :len(TRACKS_COLUMNS)])
+        else:
+            np.savetxt(self.writer, rows, fmt='%g', delimiter=' ', newline=' \n')
+
+    def flush(self):
+        if self.size:
+            self._write_block(self.buffer[:self.size])
+            self.size = 0
+        if not self.binary:
+            self.writer.flush()
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.flush()
+        self.writer.close()
+        self.writer = None
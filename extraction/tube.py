@@ -0,0 +1,238 @@
+import os
+from multiprocessing import shared_memory
+from os import path
+
+import numpy as np
+
+
+class Tube:
+    """
+    Activity tube of an object. Bounding boxes are stored as a contiguous (L, 4) int32
+    array of x, y, w, h rows together with the frame index of each row.
+    """
+    __slots__ = ('tag', 'color', 'sframe', 'eframe', '_boxes', '_frames', '_length')
+
+    def __init__(self, tag, sframe, eframe):
+        self.tag = tag
+        self.color = None  # the appearance time after re-arranging tubes - color of the start frame
+        self.sframe = sframe
+        self.eframe = eframe
+        capacity = max(int(eframe - sframe) + 1, 1)
+        self._boxes = np.empty((capacity, 4), dtype=np.int32)  # bounding boxes x, y, w, h
+        self._frames = np.empty(capacity, dtype=np.int32)  # frame index of each bounding box
+        self._length = 0
+
+    @classmethod
+    def from_arrays(cls, tag, boxes, frames=None, sframe=None, eframe=None):
+        """
+        Build a tube from an (L, 4) array of x, y, w, h bounding boxes.
+        If frames is None, boxes are assigned to consecutive frames starting from sframe.
+        int32 inputs are not copied, so the tube can be a view of a bigger array.
+        """
+        boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        if frames is None:
+            assert sframe is not None, "Expected either frames or sframe to build a tube"
+            frames = np.arange(sframe, sframe + len(boxes), dtype=np.int32)
+        frames = np.asarray(frames, dtype=np.int32)
+        assert len(frames) == len(boxes), \
+            f"Expected one frame index per bounding box but got {len(frames)} frames and {len(boxes)} boxes"
+
+        sframe = int(frames[0]) if sframe is None else sframe
+        eframe = int(frames[-1]) if eframe is None else eframe
+        tube = cls.__new__(cls)
+        tube.tag = tag
+        tube.color = None
+        tube.sframe = sframe
+        tube.eframe = eframe
+        tube._boxes = boxes
+        tube._frames = frames
+        tube._length = len(boxes)
+        return tube
+
+    @property
+    def boxes(self):
+        """(L, 4) view of the x, y, w, h bounding boxes"""
+        return self._boxes[:self._length]
+
+    @property
+    def frames(self):
+        """(L,) view of the frame indices"""
+        return self._frames[:self._length]
+
+    @property
+    def bbX(self):
+        return self.boxes[:, 0]  # bounding box x-axis
+
+    @property
+    def bbY(self):
+        return self.boxes[:, 1]  # bounding box y-axis
+
+    @property
+    def bbW(self):
+        return self.boxes[:, 2]  # bounding box width
+
+    @property
+    def bbH(self):
+        return self.boxes[:, 3]  # bounding box height
+
+    def __len__(self):
+        return self._length
+
+    def frame_length(self):
+        return self.eframe - self.sframe
+
+    def next_bounding_box(self, x, y, w, h):
+        if self._length == len(self._boxes):
+            # Double the capacity so that appending stays amortized O(1)
+            capacity = 2 * len(self._boxes)
+            boxes = np.empty((capacity, 4), dtype=np.int32)
+            frames = np.empty(capacity, dtype=np.int32)
+            boxes[:self._length] = self.boxes
+            frames[:self._length] = self.frames
+            self._boxes, self._frames = boxes, frames
+        self._boxes[self._length] = x, y, w, h
+        self._frames[self._length] = self.sframe + self._length
+        self._length += 1
+
+    def get_bounding_box_at_frame(self, frame):
+        i = frame - self.sframe
+        x, y, w, h = self.boxes[i].tolist()
+        return x, y, w, h
+
+    def as_array(self):
+        """
+        Return an (L, 5) int32 array whose rows are x, y, w, h, frame
+        """
+        return np.column_stack((self.boxes, self.frames))
+
+    def __iter__(self):
+        # A fresh iterator over (x, y, w, h, frame) tuples each time, so nested
+        # or concurrent iterations of the same tube do not share any state
+        return zip(*self.boxes.T.tolist(), self.frames.tolist())
+
+    def __str__(self):
+        return self.tag
+
+
+class TubeStore:
+    """
+    Columnar table holding the bounding boxes of all tubes in one shared array.
+    - table: (N, 6) int32 array, each row is tube_id, frame, x, y, w, h
+    - offsets: rows of the i-th tube are table[offsets[i]:offsets[i + 1]]
+    - tags, sframes, eframes: tag, starting frame and ending frame of each tube
+    Tubes given by the store are views into the table, so nothing is copied.
+    """
+    COLUMNS = ('tube_id', 'frame', 'x', 'y', 'w', 'h')
+    ARRAYS = ('table', 'offsets', 'tags', 'sframes', 'eframes')
+
+    def __init__(self, table, offsets, tags, sframes, eframes):
+        self.table = table
+        self.offsets = offsets
+        self.tags = tags
+        self.sframes = sframes
+        self.eframes = eframes
+        self.shm = None  # shared memory block backing the table, if any
+
+    @classmethod
+    def from_tubes(cls, tubes):
+        """
+        Gather the bounding boxes of a list of tubes into a single table
+        """
+        lengths = np.array([len(tube) for tube in tubes], dtype=np.int64)
+        offsets = np.zeros(len(tubes) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        table = np.empty((offsets[-1], len(cls.COLUMNS)), dtype=np.int32)
+        table[:, 0] = np.repeat(np.arange(len(tubes), dtype=np.int32), lengths)
+        for i, tube in enumerate(tubes):
+            start, end = offsets[i], offsets[i + 1]
+            table[start:end, 1] = tube.frames
+            table[start:end, 2:] = tube.boxes
+
+        tags = np.array([tube.tag for tube in tubes])
+        sframes = np.array([tube.sframe for tube in tubes], dtype=np.int64)
+        eframes = np.array([tube.eframe for tube in tubes], dtype=np.int64)
+        return cls(table, offsets, tags, sframes, eframes)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        rows = self.table[start:end]
+        return Tube.from_arrays(self.tags[i].item(), rows[:, 2:], frames=rows[:, 1],
+                                sframe=int(self.sframes[i]), eframe=int(self.eframes[i]))
+
+    def tubes(self):
+        return [self[i] for i in range(len(self))]
+
+    def save(self, store_dir):
+        """
+        Save every array of the store as a .npy file under store_dir
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(path.join(store_dir, f'{name}.npy'), getattr(self, name))
+        return store_dir
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode='r'):
+        """
+        Load a store written by save. With mmap_mode the table is memory-mapped
+        and only the pages of the tubes being read are loaded from disk.
+        """
+        arrays = {name: np.load(path.join(store_dir, f'{name}.npy'), mmap_mode=mmap_mode if name == 'table' else None)
+                  for name in cls.ARRAYS}
+        return cls(**arrays)
+
+    def to_shared_memory(self):
+        """
+        Copy the table into a shared memory block so other processes can read it without copies.
+        Returns the shared store and a picklable handle to pass to from_shared_memory in workers.
+        The caller is responsible for calling unlink on the returned store when all workers are done.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(self.table.nbytes, 1))
+        table = np.ndarray(self.table.shape, dtype=self.table.dtype, buffer=shm.buf)
+        table[:] = self.table
+        store = TubeStore(table, self.offsets, self.tags, self.sframes, self.eframes)
+        store.shm = shm
+
+        handle = {
+            'name': shm.name,
+            'shape': self.table.shape,
+            'dtype': self.table.dtype.str,
+            'offsets': self.offsets,
+            'tags': self.tags,
+            'sframes': self.sframes,
+            'eframes': self.eframes
+        }
+        return store, handle
+
+    @classmethod
+    def from_shared_memory(cls, handle):
+        """
+        Attach to a table shared by to_shared_memory
+        """
+        shm = shared_memory.SharedMemory(name=handle['name'])
+        table = np.ndarray(handle['shape'], dtype=np.dtype(handle['dtype']), buffer=shm.buf)
+        store = cls(table, handle['offsets'], handle['tags'], handle['sframes'], handle['eframes'])
+        store.shm = shm
+        return store
+
+    def close(self):
+        """
+        Detach from the shared memory block, tubes taken from this store must not be used afterwards
+        """
+        if self.shm is not None:
+            self.table = None
+            self.shm.close()
+            self.shm = None
+
+    def unlink(self):
+        """
+        Release the shared memory block, only the process that created it should call this
+        """
+        if self.shm is not None:
+            shm = self.shm
+            self.close()
+            shm.unlink()
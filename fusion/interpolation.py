@@ -1,5 +1,7 @@
 import numpy as np
 
+INTERPOLATED_KEYS = ("x", "y", "w", "h")
+
 
 def _unique_tags(frames):
     tags = set()
@@ -22,6 +24,23 @@ def extract_frames_by_tag(frames, tag):
     return tag_frames
 
 
+def group_by_tag(frames):
+    """
+    Group the objects of the frames dictionary by tag in a single pass.
+    Returns a dictionary tag -> (sorted frames, objects at these frames), keeping the first object
+    of a tag in a frame as extract_frames_by_tag does
+    """
+    by_tag = {}
+    for frame in sorted(frames):
+        for object_data in frames[frame]:
+            tag_frames, objects = by_tag.setdefault(object_data.get("tag"), ([], []))
+            if tag_frames and tag_frames[-1] == frame:
+                continue
+            tag_frames.append(frame)
+            objects.append(object_data)
+    return by_tag
+
+
 def params_to_interpolate_by_tag(tag_frames):
     x, y, f = [], [], []
     for content in tag_frames.values():
@@ -33,37 +52,25 @@ def params_to_interpolate_by_tag(tag_frames):
 
 def complete_frames(frames):
     """
-    Complete the frames dictionary interpolating the missing bounding boxes
+    Complete the frames dictionary interpolating the missing bounding boxes.
+    A missing box is a copy of the previous box of its tag, with x, y and, when present, w and h
+    linearly interpolated between the boxes around it.
     """
-    tags = _unique_tags(frames)
     last_frame = max(frames.keys())
     interpolated_frames = {i: [] for i in range(1, last_frame + 1)}
-    for tag in tags:
-        tag_frames = extract_frames_by_tag(frames, tag)
-        frames_of_tag = list(tag_frames.keys())
-        frames_of_tag.sort()
-
-        # X, Y, F = params_to_interpolate_by_tag(tag_frames)
-        for i in range(1, len(frames_of_tag)):
-            prev_frame = frames_of_tag[i-1]
-            curr_frame = frames_of_tag[i]
-            xp = [prev_frame, curr_frame]
-            ypX = [tag_frames[prev_frame]["x"], tag_frames[curr_frame]["x"]]
-            ypY = [tag_frames[prev_frame]["y"], tag_frames[curr_frame]["y"]]
-
-            if curr_frame == prev_frame + 1:
-                continue
-
-            for j in range(prev_frame + 1, curr_frame):
-                x_pred = np.interp(j, xp, ypX)
-                y_pred = np.interp(j, xp, ypY)
-
-                tag_frames[j] = tag_frames[prev_frame].copy()
-                tag_frames[j]["x"] = x_pred
-                tag_frames[j]["y"] = y_pred
+    for tag_frames, objects in group_by_tag(frames).values():
+        # Every frame of the tag from its first to its last box, interpolated at once
+        span = np.arange(tag_frames[0], tag_frames[-1] + 1)
+        previous = (np.searchsorted(tag_frames, span, side="right") - 1).tolist()
+        keys = [key for key in INTERPOLATED_KEYS if all(key in data for data in objects)]
+        values = {key: np.interp(span, tag_frames, [data[key] for data in objects]).tolist() for key in keys}
 
-        for frame in range(1, last_frame):
-            if frame not in tag_frames:
+        for i, frame in enumerate(span.tolist()):
+            if frame not in interpolated_frames:
                 continue
-            interpolated_frames[frame].append(tag_frames[frame])
+            data = objects[previous[i]].copy()
+            if tag_frames[previous[i]] != frame:
+                for key in keys:
+                    data[key] = values[key][i]
+            interpolated_frames[frame].append(data)
     return interpolated_frames
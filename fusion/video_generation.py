@@ -1,3 +1,4 @@
+from collections.abc import Mapping
 from os import access, path
 import datetime
 import cv2
@@ -7,22 +8,57 @@ from fusion.interpolation import complete_frames
 from utils.helpers import get_video_shape
 
 
-def generate_frames(dataframe, patches_path):
-    frames = {}
-    for idx, row in dataframe.iterrows():
-        nf = int(row['newframe'])
-        if nf not in frames:
-            frames[nf] = []
-        patch_path = path.join(patches_path, f'{row["tag"]}_{row["frame"]}.png')
-        frames[nf].append({
-            'tag': int(row['tag']),
-            'file': patch_path,
-            'x': int(row['x']),
-            'y': int(row['y']),
-            'h': int(row['h']),
-            'frame': int(row['frame'])
-        })
-    return frames
+FRAME_COLUMNS = ('tag', 'x', 'y', 'h', 'frame')
+
+
+class FrameTable(Mapping):
+    """
+    Rows of the aggregated dataframe grouped by their new frame, stored as columns.
+    The rows of new frame frames[i] are the rows offsets[i]:offsets[i + 1] of every column.
+    Reads as a dictionary new frame -> list of objects, the objects of a frame being built
+    only when it is accessed, while columns(new_frame) gives the arrays of a frame directly.
+    """
+
+    def __init__(self, frames, offsets, columns):
+        self.frames = frames
+        self.offsets = offsets
+        self.data = columns
+        self._positions = {frame: i for i, frame in enumerate(frames.tolist())}
+
+    def columns(self, new_frame):
+        """Dictionary column -> array of the rows of new_frame"""
+        i = self._positions[new_frame]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {name: column[start:end] for name, column in self.data.items()}
+
+    def __getitem__(self, new_frame):
+        columns = self.columns(new_frame)
+        return [dict(zip(columns, row)) for row in zip(*(column.tolist() for column in columns.values()))]
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, new_frame):
+        return new_frame in self._positions
+
+    def copy(self):
+        return self  # read-only
+
+
+def generate_frames(dataframe):
+    """
+    Group the rows of the aggregated dataframe by their new frame.
+    The patch of each object is read from the patch store by its tag and original frame.
+    """
+    new_frames = dataframe['newframe'].to_numpy().astype(np.int64)
+    order = np.argsort(new_frames, kind='stable')  # rows of a frame stay in the order of the dataframe
+    frames, starts = np.unique(new_frames[order], return_index=True)
+    offsets = np.append(starts, len(order))
+    columns = {name: dataframe[name].to_numpy().astype(np.int64)[order] for name in FRAME_COLUMNS}
+    return FrameTable(frames, offsets, columns)
 
 
 def generate_synopsis(frames, output_dir, fps, background_path, interp=False):
@@ -5,7 +5,7 @@ from utils.io import create_json_file, load_tubes_from_json_file
 meta_txt_path = "/home/pducanh/Desktop/pcgvs/data/meta.txt"
 frame_json_path = "/home/pducanh/Desktop/pcgvs/data/meta.json"
 
-frames_dict = create_json_file(meta_txt_path, frame_json_path)
+create_json_file(meta_txt_path, frame_json_path)
 tubes = load_tubes_from_json_file(frame_json_path)
 
 print("Calculating the relations map")
@@ -1,8 +1,43 @@
 import json
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
-from extraction import Tube
+from extraction import Tube, TracksWriter, load_tubes_from_arrays, load_tubes_from_pandas_dataframe
+from extraction.tracks_file import TRACKS_COLUMNS, load_tracks
+
+
+def iter_meta_frames(meta_txt_path):
+    """
+    Stream the meta file and yield (frame index, objects) for each frame, where objects
+    is the list of [object_id, x, y, w, h, image_path] of that frame.
+    A new frame starts whenever the datetime of a line differs from the previous line.
+    Each line is tokenized once and only the current frame is kept in memory.
+    """
+    num_frames = 0
+    prev_frame_index = None
+    objects = []
+
+    with open(meta_txt_path, "r") as f:
+        for line in f:
+            fields = line.split()
+            frame_index = fields[22][0:5]  # The last number of datetime
+            if prev_frame_index is not None and frame_index != prev_frame_index:
+                yield num_frames, objects
+                num_frames += 1
+                objects = []
+            prev_frame_index = frame_index
+
+            object_id = fields[3][0:5]
+            x = fields[7][1:-1]
+            y = fields[8][0:-1]
+            w = fields[9][0:-1]
+            h = fields[10][0:-2]
+            image_path = fields[12].split('/')[-1][:-2]
+            objects.append([object_id, int(x), int(y), int(w), int(h), image_path])
+
+    if objects:
+        yield num_frames, objects
 
 
 def create_json_file(meta_txt_path, frames_dict_json_path):
@@ -11,37 +46,17 @@ def create_json_file(meta_txt_path, frames_dict_json_path):
     About frames dictionary:
     - keys are index number of frame
     - values are list of objects that appear in the scene
+    The dictionary is written frame by frame while the meta file is parsed, so memory
+    usage does not grow with the size of the meta file.
     """
-    frames = {}
-    frame_indices = []
-    frame_order = [0]  # frame id regarding to line
-    num_frames = 0
-
-    with open(meta_txt_path, "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            frame_index = line.split()[22][0:5]  # The last number of datetime
-            frame_indices.append(frame_index)
-
-        for i in range(0, len(frame_indices) - 1):
-            if frame_indices[i] != frame_indices[i + 1]:
-                num_frames += 1
-            frame_order.append(num_frames)
-        for i, num_frames in enumerate(frame_order):
-            line = lines[i]
-            object_id = line.split()[3][0:5]
-            x = line.split()[7][1:-1]
-            y = line.split()[8][0:-1]
-            w = line.split()[9][0:-1]
-            h = line.split()[10][0:-2]
-            image_path = line.split()[12].split('/')[-1][:-2]
-
-            if int(num_frames) not in frames.keys():
-                frames[int(num_frames)] = []
-            frames[int(num_frames)].append([object_id, int(x), int(y), int(w), int(h), image_path])
     with open(frames_dict_json_path, "w") as f:
-        json.dump(frames, f, indent=4)
-    return frames
+        f.write("{")
+        for num_frames, objects in iter_meta_frames(meta_txt_path):
+            if num_frames > 0:
+                f.write(",\n")
+            f.write(f'"{num_frames}": {json.dumps(objects)}')
+        f.write("}\n")
+    return frames_dict_json_path
 
 
 def load_tubes_from_json_file(frames_dict_json_path):
@@ -95,25 +110,24 @@ def load_dataframe_from_json_file(json_path):
     return df
 
 
-def load_tubes_from_pandas_dataframe(df):
-    tubes = []
-    total_num_frames = df.frame.max()
-
-    for tag in df.tag.unique():
-        ob_df = df[df["tag"] == tag]
-        if len(ob_df) < 10:
-            continue  # remove shadows
-        ob_df = ob_df.sort_values(by='frame')
-        start_frame = ob_df.frame.min()
-        end_frame = ob_df.frame.max()
-
-        # TODO: Fix this check. It's better to determine if an object
-        # is stationary using the coordinates instead of this.
-        if end_frame - start_frame >= total_num_frames - 20:
-            continue  # remove stationary objects
+def create_tracks_file(meta_txt_path, tracks_path):
+    """
+    Same as create_json_file but writes the frames into a binary tracks file.
+    Image paths are not kept, patches are found by tag and frame.
+    """
+    with TracksWriter(tracks_path) as writer:
+        for num_frames, objects in iter_meta_frames(meta_txt_path):
+            rows = [[num_frames, int(object_id), x, y, w, h] for object_id, x, y, w, h, _ in objects]
+            writer.write(rows)
+    return tracks_path
 
-        tube = Tube(tag, start_frame, end_frame)
-        tubes.append(tube)
-        for _, r in ob_df.iterrows():
-            tube.next_bounding_box(r['x'], r['y'], r['w'], r['h'])
-    return tubes
+
+def load_dataframe_from_tracks_file(tracks_path, start_frame=None, end_frame=None):
+    rows = load_tracks(tracks_path, start_frame, end_frame)
+    df: DataFrame = pd.DataFrame(np.array(rows), columns=list(TRACKS_COLUMNS))
+    return df
+
+
+def load_tubes_from_tracks_file(tracks_path, start_frame=None, end_frame=None):
+    rows = load_tracks(tracks_path, start_frame, end_frame)
+    return load_tubes_from_arrays(rows[:, 1], rows[:, 0], rows[:, 2:])